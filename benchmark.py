@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+#     BENCHMARK.PY
+# (c) 2014 1248 Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Benchmarks
+# ----
+# Times (and where it makes sense, measures the memory of) the main paths through these tools:
+# building, serialising, parsing (from JSON and binary snapshots) and searching catalogues with hypercat.py, and crawling (leaderboard.py)
+# and publishing (pathfinder_client.py) against a local stand-in Pathfinder server, so no network is needed.
+#
+# Usage:
+#    python benchmark.py [--sizes 1000,10000,100000] [--save results.json] [--baseline baseline.json] [--tolerance 1.25]
+#
+# Results are printed, and can be saved as JSON. Given a baseline (a previously saved results file), each
+# benchmark is compared with it, and the exit status is 1 if any has become more than <tolerance> times slower
+# (or bigger). Timings are the best of several runs, to reduce noise.
+#
+# Besides "seconds", each result may have:
+#    heapBytes       memory held by what was built, measured by walking its objects (see membench.py)
+#    docBytes        length of the JSON document produced or parsed
+#    fileBytes       size of the file written
+#    peakRSSBytes    how much the process's peak memory grew while running it (so these are run first, while it's still low)
+#
+
+import os, sys, time, json, tempfile, platform, argparse, resource, StringIO
+from hypercat_py import hypercat, membench
+from pathfinder_py import pathfinder_client, pathfinder_server
+import leaderboard
+
+REPEATS = 3
+PATH_REL = "urn:X-1248:rels:name"
+KEY = "BENCHMARKSECRET"
+
+def best(fn, repeats=REPEATS):
+    # Best time of <repeats> calls of <fn>, in seconds
+    times = []
+    for i in range(repeats):
+        t = time.time()
+        fn()
+        times.append(time.time() - t)
+    return min(times)
+
+def peakRSS():
+    # The most memory this process has used so far, in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024     # (Linux reports kilobytes)
+
+def bestWithPeak(fn):
+    # As best(), also returning how much <fn> grew the peak memory of the process
+    before = peakRSS()
+    seconds = best(fn)
+    return (seconds, peakRSS() - before)
+
+def makeCatalogue(n):
+    # A catalogue of <n> resources, as membench uses
+    return membench.makeCatalogue(n)
+
+def makePathTree(depth, fanout):
+    # A tree of catalogues, each named (by PATH_REL) for its position among its siblings
+    h = hypercat.Hypercat("Level "+str(depth))
+    if depth > 0:
+        for i in range(fanout):
+            c = makePathTree(depth-1, fanout)
+            c.addRelation(PATH_REL, str(i))
+            h.addItem(c, "http://example.com/"+str(depth)+"/"+str(i))
+    return h
+
+def benchCatalogue(n, results):
+    h = [None]
+    def build():
+        h[0] = makeCatalogue(n)
+    results["addItem/%d" % n] = { "seconds" : best(build), "heapBytes" : membench.itemsSize(h[0]) }
+    h = h[0]
+
+    def serialise():
+        h._invalidate()     # Time the encoding, not the cache
+        h.asJSONstr()
+    results["asJSONstr/%d" % n] = { "seconds" : best(serialise), "docBytes" : len(h.asJSONstr()) }
+
+    def pretty():
+        h._invalidate()
+        h.prettyprint()
+    results["prettyprint/%d" % n] = { "seconds" : best(pretty), "docBytes" : len(h.prettyprint()) }
+
+    s = h.asJSONstr()
+    results["loads/%d" % n] = { "seconds" : best(lambda: hypercat.loads(s)), "docBytes" : len(s), "heapBytes" : membench.itemsSize(hypercat.loads(s)) }
+    results["loads-compact/%d" % n] = { "seconds" : best(lambda: hypercat.loads(s, compact=True)), "heapBytes" : membench.itemsSize(hypercat.loads(s, compact=True)) }
+    results["loads-lazy/%d" % n] = { "seconds" : best(lambda: hypercat.loads(s, lazy=True)) }   # (Its memory depends on which items are then used)
+    results["validate/%d" % n] = { "seconds" : best(lambda: hypercat.validate(StringIO.StringIO(s))) }
+
+    (fd, path) = tempfile.mkstemp(suffix=".snapshot")
+    os.close(fd)
+    try:
+        results["saveSnapshot/%d" % n] = { "seconds" : best(lambda: hypercat.saveSnapshot(h, path)), "fileBytes" : os.path.getsize(path) }
+        results["loadSnapshot/%d" % n] = { "seconds" : best(lambda: hypercat.loadSnapshot(path)), "heapBytes" : membench.itemsSize(hypercat.loadSnapshot(path)) }
+    finally:
+        os.remove(path)
+
+def benchFindByPath(results, depth=4, fanout=10, lookups=10000):
+    h = makePathTree(depth, fanout)
+    paths = [ "/".join([str((i * (d+7)) % fanout) for d in range(depth)]) for i in range(lookups) ]
+    def find():
+        for p in paths:
+            assert h.findByPath(PATH_REL, p) is not None
+    seen = set()
+    indexes = sum([ membench.deepSize(c._pathIndex, seen) for (c, depth) in h.walk() ])    # (Built by the lookups)
+    results["findByPath/%d" % lookups] = { "seconds" : best(find), "heapBytes" : indexes }
+
+def benchCrawl(server, results, depth=2, fanout=5, meters=20):
+    root = server.addSyntheticTree(depth, fanout, meters, name="bench"+str(depth))
+    count = meters * (fanout ** depth)
+    def crawl():
+        L = leaderboard.crawl(root, KEY, leaderboard.ENERGY, lambda href, key, metadata: href)
+        assert len(L) == count, len(L)
+    (seconds, peak) = bestWithPeak(crawl)
+    results["crawl/%d" % count] = { "seconds" : seconds, "peakRSSBytes" : peak }
+
+def benchCreate(server, results, catalogues=50, items=100):
+    h = makeCatalogue(items)
+    def create():
+        for i in range(catalogues):
+            pathfinder_client.Catalogue(server.url+"/cats/bench"+str(i), KEY).create(h)
+    (seconds, peak) = bestWithPeak(create)
+    results["Catalogue.create/%dx%d" % (catalogues, items)] = { "seconds" : seconds, "peakRSSBytes" : peak }
+
+def run(sizes):
+    results = {}
+    server = pathfinder_server.PathfinderServer(key=KEY).start()
+    try:
+        print "Crawling and publishing against", server.url    # (First, so that their growth of the peak memory shows)
+        benchCrawl(server, results)
+        benchCreate(server, results)
+    finally:
+        leaderboard.TRANSPORT.close()
+        pathfinder_client.TRANSPORT.close()
+        server.stop()
+    for n in sizes:
+        print "Catalogues of", n, "items"
+        benchCatalogue(n, results)
+    print "findByPath"
+    benchFindByPath(results)
+    return { "python" : platform.python_version(), "platform" : platform.platform(), "time" : time.time(), "results" : results }
+
+MEASURES = ["seconds", "heapBytes", "docBytes", "fileBytes", "peakRSSBytes"]    # Each compared with the same measure in the baseline
+
+def compare(report, baseline, tolerance):
+    # Prints each result against the baseline, returning the names of those which have regressed
+    regressions = []
+    for name in sorted(report["results"]):
+        now = report["results"][name]
+        then = baseline["results"].get(name)
+        line = "%-36s %10.4fs" % (name, now["seconds"])
+        if then is None:
+            print line, "  (not in baseline)"
+            continue
+        for measure in MEASURES:
+            if (measure in now) and then.get(measure):
+                ratio = float(now[measure]) / then[measure]
+                line += "  %s x%.2f" % (measure, ratio)
+                if ratio > tolerance:
+                    line += " REGRESSED"
+                    regressions.append(name)
+        print line
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks hypercat.py, crawling and publishing")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated catalogue sizes (e.g. 1000,10000,100000,1000000)")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare with results previously saved in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="ratio to the baseline counted as a regression")
+    args = parser.parse_args()
+
+    report = run([int(n) for n in args.sizes.split(",")])
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print len(regressions), "regressions"
+            sys.exit(1)
+    else:
+        print json.dumps(report["results"], indent=4, sort_keys=True)
@@ -71,7 +71,15 @@
 # To deal with this, within this module we maintain a universal base class for every hypercat object.
 # Then during output, we ignore grand-children, and modify attributes as necessary.
  
+import gc
+import sys
 import json
+import mmap
+import array
+import struct
+import hashlib
+import urlparse
+import collections
 
 REL = "rel"
 VAL = "val"
@@ -93,6 +101,10 @@ SUPPORTS_SEARCH_VAL = "urn:X-tsbiot:search:simple"
 HAS_HOMEPAGE_RELATION = "urn:X-tsbiot:rels:hasHomepage"
 CONTAINS_CONTENT_TYPE_RELATION = "urn:X-tsbiot:rels:containsContentType"
 
+# Traversal orders
+DEPTH_FIRST = "depth-first"
+BREADTH_FIRST = "breadth-first"
+
 # We manage Catalogues and Resources as raw Python JSON objects (i.e. we construct them in their final form)
 
 def _values(metadata, rel):
@@ -106,94 +118,451 @@ def _values(metadata, rel):
 
     return result
 
-class Base:
+# Encoders for the two output formats. Output is always sorted, so is deterministic.
+_COMPACT = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+_PRETTY = json.JSONEncoder(sort_keys=True, indent=4, separators=(',', ': '))
+_INDENT = " " * 4
+
+def _indented(s, level):
+    """Re-indents a prettyprinted JSON string to nest it <level> levels deep
+    (safe because newlines inside JSON strings are always escaped)"""
+    return s.replace("\n", "\n" + _INDENT * level)
+
+_interned = {}
+
+def _intern(s):
+    """Returns the one shared copy of string <s> (unlike intern(), this works for unicode too)"""
+    return _interned.setdefault(s, s)
+
+class Metadata(object):
+    """An ordered list of (rel,val) pairs, as found in CATALOGUE_METADATA and ITEM_METADATA.
+    Rels may be repeated. Alongside the list we keep an index from rel to its values,
+    so that values() is a dictionary lookup rather than a scan of the whole list.
+    It reads like a list, but is changed only through its owner's addRelation()/replaceRelation(), which keep
+    the owner's cached output, and its parents' caches and indexes, up to date."""
+    __slots__ = ("_pairs", "_index")
+
+    def __init__(self, metadata=()):
+        """<metadata> is a list of {REL:rel, VAL:val} dicts, i.e. the JSON form"""
+        self._pairs = []    # (rel,val) in insertion order
+        self._index = {}    # rel -> list of vals, in insertion order
+        self._extend(metadata)
+
+    def _pairList(self):
+        return self._pairs
+
+    def _add(self, rel, val):
+        rel = _intern(rel)  # The same few rels are repeated throughout a catalogue
+        self._pairs.append((rel, val))
+        self._index.setdefault(rel, []).append(val)
+
+    def _replace(self, rel, val):
+        """Set the value of every occurrence of <rel> to <val>, in place"""
+        if rel not in self._index:
+            return
+        for i in range(len(self._pairs)):
+            if self._pairs[i][0] == rel:
+                self._pairs[i] = (rel, val)
+        self._index[rel] = [val] * len(self._index[rel])
+
+    def _extend(self, metadata):
+        for r in metadata:
+            self._add(r[REL], r[VAL])
+
+    def values(self, rel):
+        """Returns a LIST of the values of relation <rel> (a copy, so callers can't corrupt the index)"""
+        return list(self._index.get(rel, ()))
+
+    def rels(self):
+        """Returns a LIST of all the relations, in order (including repeats)"""
+        return [r for (r, v) in self._pairs]
+
+    def asJSON(self):
+        return [{REL:r, VAL:v} for (r, v) in self._pairs]
+
+    def __iter__(self):
+        return iter(self.asJSON())
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [{REL:r, VAL:v} for (r, v) in self._pairs[i]]
+        (r, v) = self._pairs[i]
+        return {REL:r, VAL:v}
+
+    def __eq__(self, other):
+        if isinstance(other, Metadata):
+            return self._pairList() == other._pairList()
+        return self.asJSON() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(self.asJSON())
+
+class CompactMetadata(Metadata):
+    """The same as Metadata, but held as one flat tuple (rel0,val0,rel1,val1...) with no index.
+    This takes a fraction of the memory, which matters when there are millions of items,
+    and for the handful of rels that most items have, scanning is about as fast as indexing."""
+    __slots__ = ()
+
+    def __init__(self, metadata=()):
+        self._pairs = ()    # Flat (rel,val,rel,val...)
+        self._index = None
+        self._extend(metadata)
+
+    def _pairList(self):
+        return zip(self._pairs[0::2], self._pairs[1::2])
+
+    def _add(self, rel, val):
+        self._pairs += (_intern(rel), val)
+
+    def _replace(self, rel, val):
+        """Set the value of every occurrence of <rel> to <val>, in place"""
+        flat = list(self._pairs)
+        for i in range(0, len(flat), 2):
+            if flat[i] == rel:
+                flat[i+1] = val
+        self._pairs = tuple(flat)
+
+    def values(self, rel):
+        """Returns a LIST of the values of relation <rel>"""
+        flat = self._pairs
+        return [flat[i+1] for i in range(0, len(flat), 2) if flat[i] == rel]
+
+    def rels(self):
+        """Returns a LIST of all the relations, in order (including repeats)"""
+        return list(self._pairs[0::2])
+
+    def asJSON(self):
+        flat = self._pairs
+        return [{REL:flat[i], VAL:flat[i+1]} for i in range(0, len(flat), 2)]
+
+    def __len__(self):
+        return len(self._pairs) / 2
+
+    def __getitem__(self, i):
+        return self.asJSON()[i]
+
+class _SearchIndex:
+    """Inverted indexes over the items of a catalogue, for simple search.
+    Maps rel, val and (rel,val) to the set of positions (in items[]) of the items which have them."""
+    def __init__(self, items):
+        self.byRel = {}
+        self.byVal = {}
+        self.byPair = {}
+        for (pos, child) in enumerate(items):
+            self.add(pos, child)
+
+    def add(self, pos, child, pairs=None):
+        for (rel, val) in (child.metadata._pairList() if pairs is None else pairs):
+            self.byRel.setdefault(rel, set()).add(pos)
+            self.byVal.setdefault(val, set()).add(pos)
+            self.byPair.setdefault((rel, val), set()).add(pos)
+
+    def update(self, pos, child, added, removed):
+        """The item at <pos>, now <child>, has gained (rel,val) pairs <added> and lost <removed>.
+        A position is only dropped from a set if <child> no longer has that rel, val or pair at all."""
+        pairs = set(child.metadata._pairList())
+        rels = set([rel for (rel, val) in pairs])
+        vals = set([val for (rel, val) in pairs])
+        for (rel, val) in removed:
+            if (rel, val) not in pairs:
+                self.byPair.get((rel, val), set()).discard(pos)
+            if rel not in rels:
+                self.byRel.get(rel, set()).discard(pos)
+            if val not in vals:
+                self.byVal.get(val, set()).discard(pos)
+        self.add(pos, child, added)
+
+    def find(self, rel=None, val=None):
+        """Returns the set of positions of items matching rel and/or val (both on the same relation), or None for "all" """
+        if (rel is not None) and (val is not None):
+            return self.byPair.get((rel, val), set())
+        if rel is not None:
+            return self.byRel.get(rel, set())
+        if val is not None:
+            return self.byVal.get(val, set())
+        return None
+
+class Base(object):
     # Functionality common to both Catalogues and Resources
-    def __init__(self):
-        self.metadata = []  # Called either CATALOGUE_METADATA or RESOURCE_METADATA
-        self.items = []     # Only for Catalogues. Held as list of instances.
+    # Slots, so that millions of Resources don't each carry a __dict__
+    __slots__ = ("metadata", "items", "href", "_parents", "_cache")
+
+    def __init__(self, compact=False):
+        """If <compact>, metadata is held in a CompactMetadata, which uses less memory"""
+        self.metadata = CompactMetadata() if compact else Metadata()  # Called either CATALOGUE_METADATA or RESOURCE_METADATA
+        self.items = ()     # Only for Catalogues. Held as list of instances.
         self.href = None    # Only for Resources
+        self._parents = ()  # Catalogues which we are an item of (a tuple, because usually there's just one)
+        self._cache = None  # Output cached since we last changed, e.g. {"compact":asJSONstr()}
+
+    def _cached(self, name, fn):
+        """Returns fn(), remembering the result as <name> until this object next changes"""
+        if self._cache is None:
+            self._cache = {}
+        if name not in self._cache:
+            self._cache[name] = fn()
+        return self._cache[name]
+
+    def _invalidate(self):
+        """Our output has changed, so forget anything cached about it"""
+        self._cache = None
+
+    def _removeParent(self, parent):
+        if parent not in self._parents:     # <parent> only held a view of us (e.g. a shard), without taking ownership
+            return
+        i = self._parents.index(parent)
+        self._parents = self._parents[:i] + self._parents[i+1:]
+
+    def _metadataChanged(self, added=None, removed=()):
+        # Our metadata and href appear in our own output, and also in the output of every catalogue we're an item of
+        # (but no further up, since only one level of catalogue is output at a time)
+        # If known, <added> and <removed> are the (rel,val) pairs which have changed, so those catalogues can update their indexes to match
+        self._invalidate()
+        for p in self._parents:
+            p._itemChanged(self, added, removed)
 
     def addRelation(self, rel, val):
-        self.metadata += [{REL:rel, VAL:val}]
+        self.metadata._add(rel, val)
+        self._metadataChanged([(rel, val)])
 
     def replaceRelation(self, rel, val):
-        for i in range(len(self.metadata)):
-            if self.metadata[i][REL]==rel:
-                self.metadata[i][REL]=val
+        old = self.metadata.values(rel)
+        self.metadata._replace(rel, val)
+        self._metadataChanged([(rel, val)] if old else [], [(rel, v) for v in old])
 
     def rels(self):
         """Returns a LIST of all the metadata relations"""
-        r = []
-        for i in self.metadata:
-            r = r + i[REL]
-        return []
+        return self.metadata.rels()
         
     def values(self, rel):
         """Returns a LIST of the values of all relations of type rel, since HyperCat allows rels to be repeated"""
-        return _values(self.metadata, rel)
+        return self.metadata.values(rel)
     
     def prettyprint(self):
         """Return hypercat formatted prettily"""
-        return json.dumps(self.asJSON(), sort_keys=True, indent=4, separators=(',', ': '))
+        return self._cached("pretty", lambda: _PRETTY.encode(self.asJSON()))
 
     def asJSONstr(self):
         """Return hypercat as a string, of minimum length"""
-        return json.dumps(self.asJSON(), sort_keys=True, separators=(',', ':'))
+        return self._cached("compact", lambda: _COMPACT.encode(self.asJSON()))
+
+    def etag(self):
+        """Returns an HTTP entity-tag for asJSONstr(), i.e. a hash of the content which changes only when it does"""
+        return self._cached("etag", lambda: '"' + hashlib.sha1(self.asJSONstr()).hexdigest() + '"')
+
+    def iterencode(self, pretty=False):
+        """Yields the output of asJSONstr() (or prettyprint()) as a series of string chunks"""
+        if pretty:
+            yield self.prettyprint()
+        else:
+            yield self.asJSONstr()
+
+    def dump(self, fp, pretty=False):
+        """Writes the output of asJSONstr() (or prettyprint()) to file-like object <fp>, chunk by chunk"""
+        for chunk in self.iterencode(pretty):
+            fp.write(chunk)
 
     def isCatalogue(self):
         return CATALOGUE_TYPE in self.values(ISCONTENTTYPE_RELATION)
 
     def setHref(self,href):
         self.href=href
+        self._metadataChanged([])   # (Metadata itself is unchanged)
         
 class Hypercat(Base):
     """Create a valid Hypercat catalogue"""
     # Catalogues must be of type catalogue, have a description, and contain at least an empty array of items
 
-    def __init__(self, description):
-        Base.__init__(self)
+    # (No __slots__ here: catalogues are relatively few, so we allow them a __dict__)
+
+    def __init__(self, description, compact=False):
+        Base.__init__(self, compact)
+        self.items = []
+        self._hrefIndex = {}    # href -> position in self.items
+        self._pathIndex = {}    # rel -> {val : position of the first item with that val}, built on demand by findByPath()
+        self._searchIndex = None    # Built on demand by search()
         assert isinstance(description, basestring), "Description argument must be a string"
         # TODO: Check description is ASCII, since JSON can only encode that
-        self.metadata = [
-            { REL:ISCONTENTTYPE_RELATION, VAL:CATALOGUE_TYPE },
-            { REL:DESCRIPTION_RELATION, VAL:description }]
+        self.addRelation(ISCONTENTTYPE_RELATION, CATALOGUE_TYPE)
+        self.addRelation(DESCRIPTION_RELATION, description)
 
     def asJSON(self, asChild=False):
         j = {}
         if(asChild):
             j[HREF] = self.href
-            j[ITEM_METADATA] = self.metadata
+            j[ITEM_METADATA] = self.metadata.asJSON()
         else:
-            j[CATALOGUE_METADATA] = self.metadata
-            j[ITEMS]=[]
-            for c in self.items:
-                j[ITEMS] += [c.asJSON(asChild=True)]
+            j[CATALOGUE_METADATA] = self.metadata.asJSON()
+            j[ITEMS] = list(self._itemsJSON())
         return j
 
+    def _itemsJSON(self):
+        """Yields the JSON form of each item, as in ITEMS"""
+        for c in self.items:
+            yield c.asJSON(asChild=True)
+
+    def iterencode(self, pretty=False):
+        """Yields the output of asJSONstr() (or prettyprint()) as a series of string chunks, one per item,
+        without building the whole catalogue in memory first. The output is identical.
+        (Keys are emitted in sorted order, i.e. CATALOGUE_METADATA before ITEMS, and HREF before ITEM_METADATA)"""
+        if self._cache and (("pretty" if pretty else "compact") in self._cache):
+            yield self._cache["pretty" if pretty else "compact"]
+            return
+        metadata = self.metadata.asJSON()
+        if not pretty:
+            yield '{"' + CATALOGUE_METADATA + '":' + _COMPACT.encode(metadata) + ',"' + ITEMS + '":['
+            sep = ""
+            for c in self._itemsJSON():
+                yield sep + _COMPACT.encode(c)
+                sep = ","
+            yield ']}'
+        else:
+            yield '{\n' + _INDENT + '"' + CATALOGUE_METADATA + '": ' + _indented(_PRETTY.encode(metadata), 1) + ',\n' + _INDENT + '"' + ITEMS + '": ['
+            sep = "\n"
+            for c in self._itemsJSON():
+                yield sep + _INDENT * 2 + _indented(_PRETTY.encode(c), 2)
+                sep = ",\n"
+            if self.items:
+                yield '\n' + _INDENT + ']\n}'
+            else:
+                yield ']\n}'
+
     def addItem(self, child, href):
         """Add a new item (a catalogue or resource) as a child of this catalogue."""
         assert isinstance(child, Base), "child must be a hypercat Catalogue or Resource"
+        assert href not in self._hrefIndex, "All items in a catalogue must have unique hrefs : "+href    # (Before changing the child)
         child.setHref(href)
-        for item in self.items:
-            assert item.href != href, "All items in a catalogue must have unique hrefs : "+href
-        self.items += [child]           # Add new
-        return        
+        self._hrefIndex[href] = len(self.items)
+        self.items.append(child)           # Add new
+        child._parents += (self,)
+        self._invalidate()
+        self._indexPaths(child, len(self.items)-1)
+        if self._searchIndex is not None:
+            self._searchIndex.add(len(self.items)-1, child)
+
+    def addItems(self, children):
+        """Add many new items at once, from an iterable of (child, href) pairs.
+        All hrefs are checked for uniqueness before any items are added."""
+        children = list(children)
+        newIndex = {}
+        for (child, href) in children:
+            assert isinstance(child, Base), "child must be a hypercat Catalogue or Resource"
+            assert (href not in self._hrefIndex) and (href not in newIndex), "All items in a catalogue must have unique hrefs : "+href
+            newIndex[href] = len(self.items) + len(newIndex)
+        for (child, href) in children:
+            child.setHref(href)
+            child._parents += (self,)
+        self._hrefIndex.update(newIndex)
+        self.items.extend([child for (child, href) in children])
+        self._invalidate()
+        for (child, href) in children:
+            self._indexPaths(child, self._hrefIndex[href])
+            if self._searchIndex is not None:
+                self._searchIndex.add(self._hrefIndex[href], child)
 
     def replaceItem(self, child, href):
         """Replace an existing child (by matching the href). Guarantees not to change the order of items[]"""
         assert isinstance(child, Base), "child item must be a hypercat Catalogue or Resource"
-        for i in range(len(self.items)):
-            if(self.items[i].href == href):
-                self.items[i] = child   # Replace existing
+        assert href in self._hrefIndex, "No such child item to replace as "+href
+        child.setHref(href)
+        old = self.items[self._hrefIndex[href]]
+        old._removeParent(self)
+        self.items[self._hrefIndex[href]] = child   # Replace existing
+        child._parents += (self,)
+        self._invalidate()
+        self._reindex(self._hrefIndex[href], child, child.metadata._pairList(), old.metadata._pairList())
+
+    def removeItems(self, hrefs):
+        """Remove the items with the given hrefs (all at once, so removing many items takes one pass). Unknown hrefs are ignored."""
+        removed = set([self._hrefIndex[href] for href in hrefs if href in self._hrefIndex])
+        if not removed:
+            return
+        hrefAt = dict([(pos, href) for (href, pos) in self._hrefIndex.iteritems()])
+        kept = []
+        for (pos, child) in enumerate(self.items):
+            if pos in removed:
+                child._removeParent(self)
+            else:
+                kept.append((child, hrefAt[pos]))
+        self.items = [child for (child, href) in kept]
+        self._hrefIndex = dict([(href, pos) for (pos, (child, href)) in enumerate(kept)])
+        self._itemChanged(None)
+
+    def removeItem(self, href):
+        """Remove the item with the given href"""
+        assert href in self._hrefIndex, "No such child item to remove as "+href
+        self.removeItems([href])
+
+    def _reorder(self, hrefs):
+        """Put items[] in the order of <hrefs>, which must be exactly the hrefs of the items"""
+        assert (len(hrefs) == len(self._hrefIndex)) and (set(hrefs) == set(self._hrefIndex)), "Can only reorder the existing items"
+        self.items = [self.items[self._hrefIndex[href]] for href in hrefs]
+        self._hrefIndex = dict([(href, pos) for (pos, href) in enumerate(hrefs)])
+        self._itemChanged(None)
+
+    def _itemChanged(self, child, added=None, removed=()):
+        # One of our items has changed its metadata, which appears in our output and may be what we index it by
+        # (<added> and <removed> are as for _metadataChanged(): if they're not known, we have to start our indexes again)
+        self._invalidate()
+        if added is None:
+            self._pathIndex = {}
+            self._searchIndex = None
+        elif added or removed:
+            pos = self._hrefIndex.get(child.href)
+            if (pos is None) or (self.items[pos] is not child):     # (An item shared with another catalogue may have the href that one gave it)
+                self._pathIndex = {}
+                self._searchIndex = None
                 return
-        assert False, "No such child item to replace as "+href
+            self._reindex(pos, child, added, removed)
+
+    def _reindex(self, pos, child, added, removed):
+        """Keep any existing path and search indexes up to date with the item at <pos>, now <child>, which has gained
+        (rel,val) pairs <added> and lost <removed>, so that changing an item costs time in its metadata, not in the catalogue"""
+        if self._searchIndex is not None:
+            self._searchIndex.update(pos, child, added, removed)
+        self._reindexPaths(pos, child, added, removed)
+
+    def _indexPaths(self, child, pos):
+        """Keep any existing path indexes up to date with newly-added item <child>, at position <pos>"""
+        for (rel, index) in self._pathIndex.iteritems():
+            for val in child.values(rel):
+                index.setdefault(val, pos)
+
+    def _reindexPaths(self, pos, child, added, removed):
+        """Keep any existing path indexes up to date with the item at <pos>, now <child>.
+        An index is only dropped (to be rebuilt when next needed) if <child> was the first item with a val it no longer has."""
+        for (rel, val) in removed:
+            if (self._pathIndex.get(rel, {}).get(val) == pos) and (val not in child.values(rel)):
+                del self._pathIndex[rel]
+        for (rel, val) in added:
+            index = self._pathIndex.get(rel)
+            if (index is not None) and (index.get(val, pos) >= pos):
+                index[val] = pos
+
+    def _pathIndexFor(self, rel):
+        if rel not in self._pathIndex:
+            index = {}
+            for (pos, child) in enumerate(self.items):
+                for val in child.values(rel):
+                    index.setdefault(val, pos)  # The first item with any given val is the one that's found
+            self._pathIndex[rel] = index
+        return self._pathIndex[rel]
+
+    def itemByHref(self, href):
+        """Returns the child item with the given href, or None"""
+        if href in self._hrefIndex:
+            return self.items[self._hrefIndex[href]]
+        return None
 
     def description(self):  # 1.0 spec is unclear about whether there can be more than one description. We assume not.
         return self.values(DESCRIPTION_RELATION)[0]
 
-    def items(self):
-        return self.items
-    
     def supportsSimpleSearch(self):
         self.addRelation(SUPPORTS_SEARCH_RELATION, SUPPORTS_SEARCH_VAL)
 
@@ -204,58 +573,819 @@ class Hypercat(Base):
         self.addRelation(CONTAINS_CONTENT_TYPE_RELATION, contentType)
 
     def findByPath(self, rel, path):
-        """Traverses children, building a path based on relation <rel>, until given path is found."""
+        """Traverses children, building a path based on relation <rel>, until given path is found.
+        Each catalogue on the path keeps an index of its items by <rel>, so this takes one lookup per level."""
         if((path=="") or (path=="/")):
             return(self)
         (front,dummy,rest) = path.lstrip("/").partition("/")
-        for child in self.items:
-            if front in child.values(rel):
-                return child.findByPath(rel, rest)
-        return None
+        pos = self._pathIndexFor(rel).get(front)
+        child = None if pos is None else self.items[pos]
+        if (child is None) or not isinstance(child, Hypercat):
+            return child if rest.strip("/") == "" else None    # (Resources are only found at the end of a path)
+        return child.findByPath(rel, rest)
+
+    def search(self, rel=None, val=None, href=None):
+        """HyperCat simple search: returns a new catalogue of those items which match all of the given
+        <rel>, <val> (on the same relation, if both are given) and <href>, in their original order.
+        Uses indexes which are built on first use and then maintained, so doesn't scan the items.
+        The result is a snapshot, sharing the item objects: it isn't updated if they change afterwards."""
+        if self._searchIndex is None:
+            self._searchIndex = _SearchIndex(self.items)
+        matches = self._searchIndex.find(rel, val)
+        if href is not None:
+            pos = self._hrefIndex.get(href)
+            if (pos is None) or ((matches is not None) and (pos not in matches)):
+                matches = set()
+            else:
+                matches = set([pos])
+        if matches is None:
+            matches = xrange(len(self.items))
+        result = Hypercat(self.description())
+        result._setItems([self.items[pos] for pos in sorted(matches)])
+        return result
+
+    def searchQuery(self, query):
+        """As search(), but taking a URL query string such as "rel=...&val=..." """
+        q = urlparse.parse_qs(query.lstrip("?"))
+        return self.search(**dict([(k, q[k][0]) for k in [REL, VAL, HREF] if k in q]))
+
+    def _setItems(self, children, hrefs=None):
+        """Sets items[] to a list of items which belong to some other catalogue, without taking ownership of them.
+        <hrefs> are the items' hrefs in this catalogue, if not (all) their current ones"""
+        self.items = children
+        if hrefs is None:
+            hrefs = [child.href for child in children]
+        self._hrefIndex = dict([(href, pos) for (pos, href) in enumerate(hrefs)])
+        self._invalidate()
+        self._pathIndex = {}
+        self._searchIndex = None
+
+    def walk(self, maxDepth=None, order=DEPTH_FIRST):
+        """Yields (catalogue, depth) for this hypercat and all its descendant hypercats (not resources),
+        each once only, even if the hierarchy shares catalogues or contains loops"""
+        return traverse(self, lambda h: [i for i in h.items if isinstance(i, Hypercat)], id, maxDepth, order)
 
     def recurse(self, fn, *args):
         """Calls fn on a hypercat and all its child hypercats (not resources)"""
-        fn(self, *args)
-        for i in self.items:
-            if isinstance(i, Hypercat):
-                self.recurse(i, *args)
+        for (h, depth) in self.walk():
+            fn(h, *args)
         
 class Resource(Base):
     """Create a valid Hypercat Resource"""
     # Resources must have an href, have a declared type, and have a description
-    def __init__(self, description, contentType):
+    __slots__ = ()
+
+    def __init__(self, description, contentType, compact=False):
         """contentType must be a string containing an RFC2046 MIME type"""
-        Base.__init__(self)
-        self.metadata = [
-            {REL:ISCONTENTTYPE_RELATION,VAL:contentType},
-            {REL:DESCRIPTION_RELATION,VAL:description}]
+        Base.__init__(self, compact)
+        self.addRelation(ISCONTENTTYPE_RELATION, contentType)
+        self.addRelation(DESCRIPTION_RELATION, description)
 
     def asJSON(self, asChild=True):
         # Resources can only be children
         j = {}
-        j[ITEM_METADATA] = self.metadata
+        j[ITEM_METADATA] = self.metadata.asJSON()
         j[HREF] = self.href
         return j
     
-def loads(inputStr):
-    """Takes a string and converts it into an internal hypercat object, with some checking"""
-    inCat = json.loads(inputStr)
-    assert CATALOGUE_TYPE in _values(inCat[CATALOGUE_METADATA], ISCONTENTTYPE_RELATION)
+def canonicalHref(href):
+    """Normalises <href> so that different ways of writing the same URL compare equal
+    (case of scheme and host, default ports, empty paths, fragments)"""
+    (scheme, netloc, path, query, fragment) = urlparse.urlsplit(href)
+    (scheme, netloc) = (scheme.lower(), netloc.lower())
+    if (scheme, netloc.rpartition(":")[2]) in [("http", "80"), ("https", "443")]:
+        netloc = netloc.rpartition(":")[0]
+    if netloc and not path:
+        path = "/"
+    return urlparse.urlunsplit((scheme, netloc, path, query, ""))
+
+def traverse(root, children, key=id, maxDepth=None, order=DEPTH_FIRST):
+    """Walks a graph of nodes from <root>, without recursion, yielding (node, depth) once for each distinct node.
+    children(node) returns (or lazily yields) a node's children in order, and key(node) says which nodes are the same
+    (e.g. id for objects, or canonicalHref of the href for remote catalogues), so shared nodes and loops are only visited once.
+    A node whose key is None (e.g. a leaf, which can't lead to a loop) isn't remembered, and is yielded each time it's reached,
+    so memory need only grow with the number of nodes that have children.
+    Nodes are yielded in pre-order if <order> is DEPTH_FIRST, or level by level if BREADTH_FIRST.
+    The root is at depth 0, and children of nodes at depth <maxDepth> are not visited. Depth-first, a node may be reached
+    first by a longer path than its shortest: it's yielded at that depth, but if it's then reached by a shorter one, its
+    children are visited again from there, so that nothing within <maxDepth> of the root is missed."""
+    seen = {}   # key -> least depth at which the node has been reached
+    if key(root) is not None:
+        seen[key(root)] = 0
+    expand = lambda depth: (maxDepth is None) or (depth < maxDepth)
+    if order == DEPTH_FIRST:
+        yield (root, 0)
+        stack = [(iter(children(root)), 1)] if expand(0) else []
+        while stack:
+            (it, depth) = stack[-1]
+            for child in it:
+                k = key(child)
+                if (k is None) or (k not in seen):
+                    new = True
+                    break
+                if (maxDepth is not None) and (depth < seen[k]):  # Reached more directly than before, so it may lead further
+                    new = False
+                    break
+            else:
+                stack.pop()
+                continue
+            if k is not None:
+                seen[k] = depth
+            if new:
+                yield (child, depth)
+            if expand(depth):
+                stack.append((iter(children(child)), depth+1))
+    else:
+        assert order == BREADTH_FIRST, "Unknown traversal order "+str(order)
+        queue = collections.deque([(root, 0)])
+        while queue:
+            (node, depth) = queue.popleft()
+            yield (node, depth)
+            if expand(depth):
+                for child in children(node):
+                    k = key(child)
+                    if k not in seen:   # (Level by level, the first time a node is reached is by its shortest path)
+                        if k is not None:
+                            seen[k] = depth+1
+                        queue.append((child, depth+1))
+
+def _catalogueFromJSON(metadata, compact=False):
+    """Creates an (empty) catalogue from the JSON CATALOGUE_METADATA list, with some checking"""
+    assert CATALOGUE_TYPE in _values(metadata, ISCONTENTTYPE_RELATION)
     # Manually copy mandatory fields, to check that they are they, and exclude other garbage
-    desc = _values(inCat[CATALOGUE_METADATA], DESCRIPTION_RELATION)[0]  # TODO: We are ASSUMING just one description, which may not be true
-    outCat = Hypercat(desc)
-    for i in inCat[ITEMS]:
-        href = i[HREF]
-        contentType = _values(i[ITEM_METADATA], ISCONTENTTYPE_RELATION) [0]
-        desc = _values(i[ITEM_METADATA], DESCRIPTION_RELATION) [0]
-        if contentType == CATALOGUE_TYPE:
-            r = Hypercat(desc)
-        else:
-            r = Resource(desc, contentType)
-        outCat.addItem(r, href)
+    desc = _values(metadata, DESCRIPTION_RELATION)[0]  # TODO: We are ASSUMING just one description, which may not be true
+    return Hypercat(desc, compact)
 
+def _itemFromJSON(i, compact=False):
+    """Creates a catalogue or resource from one JSON member of ITEMS, with its href set"""
+    href = i[HREF]
+    contentType = _values(i[ITEM_METADATA], ISCONTENTTYPE_RELATION) [0]
+    desc = _values(i[ITEM_METADATA], DESCRIPTION_RELATION) [0]
+    if contentType == CATALOGUE_TYPE:
+        r = Hypercat(desc, compact)
+    else:
+        r = Resource(desc, contentType, compact)
+    r.setHref(href)
+    return r
+
+def loads(inputStr, compact=False, lazy=False, fetcher=None):
+    """Takes a string and converts it into an internal hypercat object, with some checking
+    If <compact>, items are created with compact metadata (see CompactMetadata)
+    If <lazy>, all metadata is kept (not just content type and description), and each item is kept as parsed JSON until it is
+    first accessed. If a <fetcher> is also given, fetcher(href) is called to get the JSON (a string or file-like object) of
+    a child catalogue when its own items are first needed (see _LazyHypercat)"""
+    inCat = json.loads(inputStr)
+    if lazy:
+        metadata = (CompactMetadata if compact else Metadata)(inCat[CATALOGUE_METADATA])
+        assert CATALOGUE_TYPE in metadata.values(ISCONTENTTYPE_RELATION)
+        outCat = _restored(_LazyHypercat, metadata, None)
+        outCat._load(_LazySession(fetcher, compact), inCat[ITEMS])
+        return outCat
+    assert fetcher is None, "A fetcher needs lazy=True"
+    outCat = _catalogueFromJSON(inCat[CATALOGUE_METADATA], compact)
+    outCat.addItems([(_itemFromJSON(i, compact), i[HREF]) for i in inCat[ITEMS]])
     return outCat
 
+# Sharding, so that a catalogue too big to be fetched in one go can be served as a catalogue of smaller catalogues
+
+class _ShardedHypercat(Hypercat):
+    """A catalogue of shards, as returned by shard(). findByPath() looks through the shards, as if their items were its own."""
+    def _routes(self, rel):
+        """{val : shard} for the items of all the shards, built on demand, so findByPath() needs one lookup to find the shard"""
+        routes = self.__dict__.setdefault("_shardRoutes", {})
+        if rel not in routes:
+            index = {}
+            for s in self.items:
+                for val in s._pathIndexFor(rel):
+                    index.setdefault(val, s)
+            routes[rel] = index
+        return routes[rel]
+
+    def findByPath(self, rel, path):
+        found = Hypercat.findByPath(self, rel, path)
+        if found is not None:
+            return found
+        shard = self._routes(rel).get(path.lstrip("/").partition("/")[0])
+        if shard is not None:
+            found = shard.findByPath(rel, path)
+            if found is not None:
+                return found
+        for s in self.items:    # The shards must have changed since the routes were built
+            found = s.findByPath(rel, path)
+            if found is not None:
+                return found
+        return None
+
+def _shardName(k):
+    """A name for the shard of items with key <k>, made only of [A-Za-z0-9] (as Pathfinder requires), distinct for each distinct key"""
+    k = k.encode("utf-8") if isinstance(k, unicode) else str(k)
+    return "".join([c for c in k if c.isalnum()])[:24] + hashlib.sha1(k).hexdigest()[:8]
+
+def shard(h, baseHref, maxItems=None, key=None):
+    """Splits the items of catalogue <h> among child catalogues ("shards"), returning a new catalogue, with h's metadata, whose items are the shards.
+    Items are grouped by key(item) (e.g. lambda i: i.values(ISCONTENTTYPE_RELATION)[0]) if a <key> is given, and each group is split into
+    shards of at most <maxItems> items, in their original order. Each shard's href is <baseHref> followed by a name made of [A-Za-z0-9] only,
+    which depends only on its key and its position in the group. So the shards can be published as separate Pathfinder catalogues, and when a
+    changed catalogue is sharded again, only the shards whose items have changed differ (so a Publisher re-uploads only those).
+    The shards hold the same item objects as <h>, without taking ownership of them, so they're a snapshot (as search() results are):
+    they aren't updated if the items change afterwards, and old shards aren't kept alive by the items. To make any change, change <h>
+    and shard it again."""
+    assert (maxItems is not None) or (key is not None), "Shard by maxItems, key or both"
+    assert (maxItems is None) or (maxItems > 0), "maxItems must be positive"
+    groups = collections.OrderedDict()
+    for child in h.items:
+        groups.setdefault("" if key is None else _shardName(key(child)), []).append(child)
+    compact = isinstance(h.metadata, CompactMetadata)
+    root = _ShardedHypercat(h.description(), compact)
+    root.metadata = (CompactMetadata if compact else Metadata)(h.metadata.asJSON())
+    shards = []
+    for (name, children) in groups.iteritems():
+        size = maxItems or len(children)
+        for start in range(0, len(children), size):
+            shardName = name + ("p" + str(start / size) if maxItems else "")
+            s = Hypercat(h.description() + " (" + shardName + ")", compact)
+            s._setItems(children[start:start+size])
+            shards.append((s, baseHref + shardName))
+    root.addItems(shards)
+    return root
+
+# Validation
+
+Violation = collections.namedtuple("Violation", "path message")    # path is a JSON Pointer, e.g. "/items/3/href"
+
+class _Violations:
+    """Collects violations, keeping at most <maxViolations> (but counting them all)"""
+    def __init__(self, maxViolations):
+        self.maxViolations = maxViolations
+        self.found = []
+        self.count = 0
+
+    def add(self, path, message):
+        self.count += 1
+        if (self.maxViolations is None) or (len(self.found) < self.maxViolations):
+            self.found.append(Violation(path, message))
+
+def _isASCII(s):
+    try:
+        (s.encode if isinstance(s, unicode) else s.decode)("ascii")
+        return True
+    except UnicodeError:
+        return False
+
+def _checkMetadata(metadata, path, v, isCatalogue):
+    """Checks a list of metadata (CATALOGUE_METADATA or ITEM_METADATA) at <path>"""
+    if not isinstance(metadata, list):
+        v.add(path, "must be an array")
+        return
+    (contentTypes, descriptions) = ([], [])
+    for (i, r) in enumerate(metadata):
+        rpath = path + "/" + str(i)
+        if not isinstance(r, dict):
+            v.add(rpath, "must be an object")
+            continue
+        for k in [REL, VAL]:
+            if k not in r:
+                v.add(rpath, "has no " + k)
+            elif not isinstance(r[k], basestring):
+                v.add(rpath + "/" + k, "must be a string")
+        if r.get(REL) == ISCONTENTTYPE_RELATION:
+            contentTypes.append(r.get(VAL))
+        elif r.get(REL) == DESCRIPTION_RELATION:
+            descriptions.append(r.get(VAL))
+            if isinstance(r.get(VAL), basestring) and not _isASCII(r[VAL]):
+                v.add(rpath + "/" + VAL, "description must be ASCII")
+    if not contentTypes:
+        v.add(path, "has no " + ISCONTENTTYPE_RELATION)   # Optional for items per 4.3.3, but mandatory here as elsewhere in this module
+    elif isCatalogue and (CATALOGUE_TYPE not in contentTypes):
+        v.add(path, "catalogue must have " + ISCONTENTTYPE_RELATION + " " + CATALOGUE_TYPE)
+    if not descriptions:
+        v.add(path, "has no " + DESCRIPTION_RELATION)
+
+def _checkItem(item, path, v, hrefs, n):
+    """Checks member <n> of ITEMS. <hrefs> maps a hash of each href seen so far to the item it was first seen in"""
+    if not isinstance(item, dict):
+        v.add(path, "must be an object")
+        return
+    href = item.get(HREF)
+    if href is None:
+        v.add(path, "has no " + HREF)
+    elif (not isinstance(href, basestring)) or (not href):
+        v.add(path + "/" + HREF, "must be a non-empty string")
+    else:
+        h = hashlib.sha1(href.encode("utf-8") if isinstance(href, unicode) else href).digest()
+        if h in hrefs:
+            v.add(path + "/" + HREF, "duplicates the href of /" + ITEMS + "/" + str(hrefs[h]))
+        else:
+            hrefs[h] = n
+    if ITEM_METADATA not in item:
+        v.add(path, "has no " + ITEM_METADATA)
+    else:
+        _checkMetadata(item[ITEM_METADATA], path + "/" + ITEM_METADATA, v, False)
+
+def _pointerToken(key):
+    """<key> escaped for use in a JSON Pointer (RFC 6901)"""
+    return unicode(key).replace("~", "~0").replace("/", "~1")
+
+def validate(fp, chunkSize=65536, maxViolations=1000):
+    """Checks a hypercat JSON document, read incrementally from file-like object <fp>, against the rules which loads() and
+    the Hypercat class enforce (and some they don't), without building it. Unlike them, it reports every problem.
+    Returns a list of Violation(path, message), empty if the document is valid. Memory use is bounded by the largest item,
+    a hash of each href (to check they're unique) and <maxViolations> (None for no limit)."""
+    v = _Violations(maxViolations)
+    r = _StreamReader(fp, chunkSize)
+    seen = set()
+    hrefs = {}
+    path = ""
+    try:
+        r.next("{")
+        if r.peek() == "}":
+            r.next("}")
+        else:
+            while True:
+                key = r.value()
+                if not isinstance(key, basestring):     # (So not hashable, if it's an array or object)
+                    path = ""
+                    v.add(path, "key " + json.dumps(key) + " must be a string")
+                    r.next(":")
+                    r.value()
+                    if r.next(",}") == "}":
+                        break
+                    continue
+                path = "/" + _pointerToken(key)
+                r.next(":")
+                seen.add(key)
+                if (key == ITEMS) and (r.peek() != "["):
+                    v.add(path, "must be an array")
+                    r.value()
+                elif key == ITEMS:
+                    r.next("[")
+                    if r.peek() == "]":
+                        r.next("]")
+                    else:
+                        n = 0
+                        while True:
+                            path = "/" + ITEMS + "/" + str(n)
+                            _checkItem(r.value(), path, v, hrefs, n)
+                            n += 1
+                            if r.next(",]") == "]":
+                                break
+                elif key == CATALOGUE_METADATA:
+                    _checkMetadata(r.value(), path, v, True)
+                else:
+                    r.value()
+                if r.next(",}") == "}":
+                    break
+    except ValueError, e:
+        v.add(path, "not valid JSON: " + str(e))
+    else:
+        if r.peek() != "":
+            v.add("", "has more after the end of the document")
+        for key in [CATALOGUE_METADATA, ITEMS]:
+            if key not in seen:
+                v.add("", "has no " + key)
+    if v.count > len(v.found):
+        v.found.append(Violation("", "...and %d more violations" % (v.count - len(v.found))))
+    return v.found
+
+# Lazy loading
+
+class _LazyItems(object):
+    """The items of a lazily-loaded catalogue. Behaves as a list of items, but holds each one as parsed JSON
+    until it is first accessed, and only then creates its Resource or Hypercat"""
+    __slots__ = ("_owner", "_session", "_slots")
+
+    def __init__(self, owner, session, records):
+        self._owner = owner
+        self._session = session
+        self._slots = list(records)    # Each either a JSON item or, once accessed, the item itself
+
+    def _at(self, pos):
+        x = self._slots[pos]
+        if isinstance(x, dict):
+            x = self._slots[pos] = self._session.materialise(x)
+            x._parents += (self._owner,)
+        return x
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._at(pos) for pos in xrange(*i.indices(len(self._slots)))]
+        return self._at(i)
+
+    def __setitem__(self, i, child):
+        self._slots[i] = child
+
+    def __iter__(self):
+        for pos in xrange(len(self._slots)):
+            yield self._at(pos)
+
+    def append(self, child):
+        self._slots.append(child)
+
+    def extend(self, children):
+        self._slots.extend(children)
+
+    def records(self):
+        """Yields the JSON form of each item, as in ITEMS, without creating any items"""
+        for x in self._slots:
+            if isinstance(x, dict):
+                yield {HREF : x[HREF], ITEM_METADATA : x[ITEM_METADATA]}
+            else:
+                yield x.asJSON(asChild=True)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+class _LazySession:
+    """What's shared by all the catalogues of one lazy load: how to create items, and the catalogues fetched so far"""
+    def __init__(self, fetcher, compact):
+        self.fetcher = fetcher
+        self.compact = compact
+        self.catalogues = {}    # canonicalHref -> catalogue, so that each is fetched once only, even if shared or in a loop
+
+    def materialise(self, record):
+        """Creates the Resource or Hypercat for a JSON item, keeping all of its metadata"""
+        metadata = (CompactMetadata if self.compact else Metadata)(record[ITEM_METADATA])
+        if CATALOGUE_TYPE not in metadata.values(ISCONTENTTYPE_RELATION):
+            return _restored(Resource, metadata, record[HREF])
+        if self.fetcher is None:
+            h = _restored(_LazyHypercat, metadata, record[HREF])
+            h._load(self, [])
+            return h
+        key = canonicalHref(record[HREF])
+        if key not in self.catalogues:
+            h = self.catalogues[key] = _restored(_LazyHypercat, metadata, record[HREF])
+            h._load(self, None, fetchFrom=record[HREF])
+        return self.catalogues[key]
+
+class _LazyHypercat(Hypercat):
+    """A catalogue created by loads(lazy=True). Its items are _LazyItems, and its output is generated from them without
+    creating items. A child catalogue which is to be fetched isn't fetched until its items (or href index) are first used.
+    (Its metadata is what its parent said about it, not what its own document says)"""
+    def _load(self, session, records, fetchFrom=None):
+        self.__dict__.update(_session=session, _fetchFrom=fetchFrom, _pathIndex={}, _searchIndex=None)
+        if fetchFrom is None:
+            self._fill(records)
+
+    def _fill(self, records):
+        index = dict([(r[HREF], pos) for (pos, r) in enumerate(records)])
+        assert len(index) == len(records), "All items in a catalogue must have unique hrefs"
+        Base.items.__set__(self, _LazyItems(self, self._session, records))
+        self.__dict__["_hrefIndex"] = index
+
+    def _fetch(self):
+        href = self.__dict__.get("_fetchFrom")
+        if href is not None:
+            doc = self._session.fetcher(href)
+            if hasattr(doc, "read"):
+                doc = doc.read()
+            self._fill(json.loads(doc)[ITEMS])
+            self._fetchFrom = None  # Only once it has worked, so if fetching fails, using the catalogue again tries again
+
+    def _getItems(self):
+        self._fetch()
+        return Base.items.__get__(self)
+
+    def _putItems(self, items):
+        Base.items.__set__(self, items)
+
+    def _getHrefIndex(self):
+        self._fetch()
+        return self.__dict__["_hrefIndex"]
+
+    def _putHrefIndex(self, index):
+        self.__dict__["_hrefIndex"] = index
+
+    items = property(_getItems, _putItems)
+    _hrefIndex = property(_getHrefIndex, _putHrefIndex)
+
+    def _itemsJSON(self):
+        if isinstance(self.items, _LazyItems):
+            return self.items.records()
+        return Hypercat._itemsJSON(self)
+
+class _StreamReader:
+    """Reads JSON values one at a time from a file-like object, holding only a little of it in memory"""
+    _WHITESPACE = " \t\n\r"
+
+    def __init__(self, fp, chunkSize):
+        self.fp = fp
+        self.chunkSize = chunkSize
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """Read more input (at least as much as we already hold, so that re-parsing a large value is amortised)"""
+        if self.eof:
+            return False
+        pending = self.buf[self.pos:]
+        chunk = self.fp.read(max(self.chunkSize, len(pending)))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = pending + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character without consuming it ("" at end of input)"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in self._WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def next(self, allowed):
+        """Consumes the next non-whitespace character, which must be one of <allowed>"""
+        c = self.peek()
+        if (c == "") or (c not in allowed):
+            raise ValueError("Expected one of '"+allowed+"' but found '"+c+"' in JSON stream")
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Consumes and returns the next complete JSON value"""
+        self.peek()
+        while True:
+            try:
+                (obj, end) = self.decoder.raw_decode(self.buf, self.pos)
+                if (end < len(self.buf)) or self.eof:   # A value at the very end of the buffer might be a truncated number
+                    self.pos = end
+                    return obj
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+def iterparse(fp, chunkSize=65536):
+    """Parses a hypercat JSON document incrementally from file-like object <fp>.
+    Yields (key, value) pairs: (ITEMS, item) for each member of ITEMS as soon as it has been read,
+    and (key, value) for every other top-level member (e.g. (CATALOGUE_METADATA, [...])).
+    Only one item at a time is held in memory, and the caller can stop at any point."""
+    r = _StreamReader(fp, chunkSize)
+    r.next("{")
+    if r.peek() == "}":
+        return
+    while True:
+        key = r.value()
+        r.next(":")
+        if key == ITEMS:
+            r.next("[")
+            if r.peek() == "]":
+                r.next("]")
+            else:
+                while True:
+                    yield (ITEMS, r.value())
+                    if r.next(",]") == "]":
+                        break
+        else:
+            yield (key, r.value())
+        if r.next(",}") == "}":
+            break
+
+def iterload(fp, chunkSize=65536, compact=False):
+    """Reads a hypercat incrementally from file-like object <fp>, with the same checking as loads().
+    Yields the catalogue first (without its items), then each item (a catalogue or resource, with its href set)
+    as it is parsed. Items are not added to the catalogue, so memory use stays flat however long the catalogue is.
+    (Items which precede the catalogue metadata in the document have to be held back until it is found)"""
+    cat = None
+    heldBack = []
+    for (key, value) in iterparse(fp, chunkSize):
+        if key == CATALOGUE_METADATA:
+            cat = _catalogueFromJSON(value, compact)
+            yield cat
+            for i in heldBack:
+                yield _itemFromJSON(i, compact)
+            heldBack = None
+        elif key == ITEMS:
+            if cat is None:
+                heldBack.append(value)
+            else:
+                yield _itemFromJSON(value, compact)
+    assert cat is not None, "No "+CATALOGUE_METADATA+" found"
+
+def load(fp, compact=False):
+    """Reads a hypercat from file-like object <fp>, like loads() but without holding the whole input in memory"""
+    it = iterload(fp, compact=compact)
+    cat = it.next()
+    cat.addItems([(r, r.href) for r in it])
+    return cat
+
+# Binary snapshots, for saving and restoring a whole hierarchy much faster than as JSON.
+# All numbers are little-endian unsigned 32-bit. The file is:
+#   header:     magic, number of strings, bytes of strings, number of nodes, number of pairs, number of items
+#   strings:    (number of strings + 1) offsets into the string bytes, then the (UTF-8) string bytes, padded to a multiple of 4
+#   nodes:      for each catalogue and resource: isCatalogue, href (a string number), first pair, number of pairs, first item, number of items
+#   pairs:      for each metadata (rel,val): rel, val (string numbers)
+#   items:      for each item of each catalogue: the item's node number, and its href in that catalogue (a string number)
+# Each distinct string is stored (and loaded) once, and the root is node 0. A node's own href is the last it was given,
+# so a node shared by several catalogues may be in some under a different href, which is why items have theirs too.
+
+_SNAPSHOT_MAGIC = "HCSNAP02"
+_SNAPSHOT_HEADER = struct.Struct("<8sIIIII")
+_NODE_FIELDS = 6
+_NO_HREF = 0xFFFFFFFF
+_UINT32 = "I" if array.array("I").itemsize == 4 else "L"
+
+def _padded(n):
+    return (n + 3) & ~3
+
+def saveSnapshot(h, path):
+    """Saves catalogue <h> and everything below it (each catalogue and resource once only, even if shared) to file <path>,
+    in a binary format which loadSnapshot() reads much faster than JSON"""
+    nodes = [node for (node, depth) in traverse(h, lambda n: n.items, id)]
+    numbers = dict([(id(node), i) for (i, node) in enumerate(nodes)])
+    (strings, stringNumbers) = ([], {})
+    def stringNumber(s):
+        assert isinstance(s, basestring), "Only strings can be saved in a snapshot: "+repr(s)
+        if s not in stringNumbers:
+            stringNumbers[s] = len(strings)
+            strings.append(s)
+        return stringNumbers[s]
+    (nodeRecords, pairRecords, itemRecords) = (array.array(_UINT32), array.array(_UINT32), array.array(_UINT32))
+    for node in nodes:
+        pairs = node.metadata._pairList()
+        href = _NO_HREF if node.href is None else stringNumber(node.href)
+        nodeRecords.extend([int(isinstance(node, Hypercat)), href, len(pairRecords)/2, len(pairs), len(itemRecords)/2, len(node.items)])
+        for (rel, val) in pairs:
+            pairRecords.extend([stringNumber(rel), stringNumber(val)])
+        if isinstance(node, Hypercat):
+            hrefAt = dict([(pos, itemHref) for (itemHref, pos) in node._hrefIndex.items()])
+            for (pos, child) in enumerate(node.items):
+                itemRecords.extend([numbers[id(child)], stringNumber(hrefAt[pos])])
+
+    encoded = [s.encode("utf-8") if isinstance(s, unicode) else s for s in strings]
+    offsets = array.array(_UINT32, [0])
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+    with open(path, "wb") as f:
+        f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, len(strings), offsets[-1], len(nodes), len(pairRecords)/2, len(itemRecords)/2))
+        for a in [offsets, "".join(encoded) + "\0" * (_padded(offsets[-1]) - offsets[-1]), nodeRecords, pairRecords, itemRecords]:
+            if isinstance(a, array.array) and (sys.byteorder == "big"):
+                a.byteswap()
+            f.write(a if isinstance(a, str) else a.tostring())
+
+def _restored(cls, metadata, href):
+    """A catalogue or resource with the given metadata and href, created without the checking (and work) of its constructor
+    (catalogues get their items from _setItems())"""
+    node = cls.__new__(cls)
+    (node.metadata, node.items, node.href, node._parents, node._cache) = (metadata, (), href, (), None)
+    return node
+
+def loadSnapshot(path, compact=False):
+    """Loads a hierarchy saved by saveSnapshot(), returning the root catalogue. The file is memory-mapped, and each distinct
+    string is decoded only once, so this costs little more than creating the objects.
+    If <compact>, everything is created with compact metadata (see CompactMetadata)"""
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        (magic, nStrings, stringBytes, nNodes, nPairs, nItems) = _SNAPSHOT_HEADER.unpack_from(buf, 0)
+        assert magic == _SNAPSHOT_MAGIC, path+" is not a hypercat snapshot"
+        pos = [_SNAPSHOT_HEADER.size]
+        def uints(n):
+            a = array.array(_UINT32)
+            a.fromstring(buf[pos[0]:pos[0] + 4*n])
+            if sys.byteorder == "big":
+                a.byteswap()
+            pos[0] += 4*n
+            return a
+        offsets = uints(nStrings + 1)
+        start = pos[0]
+        strings = [buf[start + offsets[i]:start + offsets[i+1]].decode("utf-8") for i in xrange(nStrings)]
+        pos[0] += _padded(stringBytes)
+        (nodeRecords, pairRecords, itemRecords) = (uints(nNodes * _NODE_FIELDS), uints(nPairs * 2), uints(nItems * 2))
+    finally:
+        buf.close()
+
+    gcWasEnabled = gc.isenabled()
+    gc.disable()    # We create millions of objects but no garbage, so collecting (repeatedly, as they're created) is wasted effort
+    try:
+        return _restoredNodes(strings, nodeRecords, pairRecords, itemRecords, compact)
+    finally:
+        if gcWasEnabled:
+            gc.enable()
+
+def _restoredNodes(strings, nodeRecords, pairRecords, itemRecords, compact):
+    """Creates the objects described by snapshot records, returning the root"""
+    nodes = []
+    for i in xrange(0, len(nodeRecords), _NODE_FIELDS):
+        (isCatalogue, href, firstPair, pairCount) = nodeRecords[i:i+4]
+        flat = [strings[n] for n in pairRecords[2*firstPair:2*(firstPair+pairCount)]]
+        if compact:
+            metadata = CompactMetadata.__new__(CompactMetadata)
+            (metadata._pairs, metadata._index) = (tuple(flat), None)
+        else:
+            metadata = Metadata.__new__(Metadata)
+            (metadata._pairs, metadata._index) = (zip(flat[0::2], flat[1::2]), {})
+            for (rel, val) in metadata._pairs:
+                metadata._index.setdefault(rel, []).append(val)
+        nodes.append(_restored(Hypercat if isCatalogue else Resource, metadata, None if href == _NO_HREF else strings[href]))
+    for (i, node) in enumerate(nodes):
+        (firstItem, itemCount) = nodeRecords[i*_NODE_FIELDS+4:i*_NODE_FIELDS+6]
+        if isinstance(node, Hypercat):
+            records = itemRecords[2*firstItem:2*(firstItem+itemCount)]
+            node._setItems([nodes[n] for n in records[0::2]], [strings[n] for n in records[1::2]])
+            for child in node.items:
+                child._parents += (node,)
+    return nodes[0]
+
+# Diffs, so that a change to a large catalogue can be passed on as just the change
+
+class Diff:
+    """The changes which turn one version of a catalogue into another, with items identified by href (see diff()).
+    Can be converted to and from JSON, e.g. to send to subscribers, and applied to a copy of the old version."""
+    def __init__(self, j=None):
+        """<j> is the output of asJSON()"""
+        j = j or {}
+        self.metadata = j.get("metadata")       # The catalogue's new metadata (JSON form), or None if unchanged
+        self.removed = j.get("removed", [])     # hrefs of items removed
+        self.changed = j.get("changed", [])     # Items whose metadata has changed (JSON form, as in ITEMS)
+        self.added = j.get("added", [])         # New items (JSON form, as in ITEMS), in order
+        self.order = j.get("order")             # hrefs of all items in their new order, if apply() wouldn't otherwise get it right
+
+    def __len__(self):
+        """The number of changes"""
+        return int(self.metadata is not None) + len(self.removed) + len(self.changed) + len(self.added) + int(self.order is not None)
+
+    def asJSON(self):
+        j = {}
+        for k in ["metadata", "order"]:
+            if getattr(self, k) is not None:
+                j[k] = getattr(self, k)
+        for k in ["removed", "changed", "added"]:
+            if getattr(self, k):
+                j[k] = getattr(self, k)
+        return j
+
+    def apply(self, h):
+        """Changes catalogue <h> (a copy of the old version) into the new version"""
+        compact = isinstance(h.metadata, CompactMetadata)
+        if self.metadata is not None:
+            h.metadata = (CompactMetadata if compact else Metadata)(self.metadata)
+            h._metadataChanged()
+        h.removeItems(self.removed)
+        for i in self.changed:
+            old = h.itemByHref(i[HREF])
+            assert old is not None, "No such child item to change as "+i[HREF]
+            new = _itemFromFullJSON(i, compact)
+            if isinstance(new, Hypercat) == isinstance(old, Hypercat):
+                old.metadata = new.metadata     # In place, so the item keeps its own items (if a catalogue), and its other parents see the change
+                old._metadataChanged()
+            else:
+                h.replaceItem(new, i[HREF])
+        h.addItems([(_itemFromFullJSON(i, compact), i[HREF]) for i in self.added])
+        if self.order is not None:
+            h._reorder(self.order)
+
+def _itemFromFullJSON(i, compact=False):
+    """Creates a catalogue (with no items) or resource from one JSON member of ITEMS, keeping all of its metadata"""
+    metadata = (CompactMetadata if compact else Metadata)(i[ITEM_METADATA])
+    if CATALOGUE_TYPE in metadata.values(ISCONTENTTYPE_RELATION):
+        node = _restored(Hypercat, metadata, i[HREF])
+        node._setItems([])
+    else:
+        node = _restored(Resource, metadata, i[HREF])
+    return node
+
+def _hrefsInOrder(h):
+    """The hrefs by which the items of catalogue <h> were added, in item order"""
+    hrefs = [None] * len(h.items)
+    for (href, pos) in h._hrefIndex.iteritems():
+        hrefs[pos] = href
+    return hrefs
+
+def diff(old, new):
+    """Returns a Diff of the changes from catalogue <old> to catalogue <new>, matching their items by href, in time linear in their sizes.
+    Like a catalogue's output, a Diff covers one level only: changes within child catalogues need diffs of their own."""
+    d = Diff()
+    if old.metadata != new.metadata:
+        d.metadata = new.metadata.asJSON()
+    oldHrefs = _hrefsInOrder(old)
+    newHrefs = _hrefsInOrder(new)
+    d.removed = [href for href in oldHrefs if href not in new._hrefIndex]
+    for (href, child) in zip(newHrefs, new.items):
+        pos = old._hrefIndex.get(href)
+        if pos is None:
+            d.added.append({HREF : href, ITEM_METADATA : child.metadata.asJSON()})
+        elif (old.items[pos] is not child) and (old.items[pos].metadata != child.metadata):
+            d.changed.append({HREF : href, ITEM_METADATA : child.metadata.asJSON()})
+    expected = [href for href in oldHrefs if href in new._hrefIndex] + [i[HREF] for i in d.added]   # Where apply() would put them
+    if expected != newHrefs:
+        d.order = newHrefs
+    return d
+
 if __name__ == '__main__':
     # Unit tests
     import unittest
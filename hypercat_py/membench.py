@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# MEMBENCH.PY
+#
+# Measures how much memory a large catalogue needs in hypercat.py's normal and compact storage modes,
+# compared with holding the same catalogue as raw JSON objects (one dict per relation, as json.loads() gives)
+#
+# Usage:
+#    python membench.py [number_of_items]
+#
+# Sizes are measured by walking the object graph with sys.getsizeof(), counting each object once
+# (so strings which are shared between items, such as interned rels, are only counted once)
+# Every mode holds all of each item's rels, parsed from the same JSON, so they hold the same data: the catalogues are loaded lazily
+# (plain loads() would keep only content type and description), with all their items then created
+
+import sys
+import json
+import hypercat
+
+RELS_PER_ITEM = [
+    ("urn:X-senml:u", "J"),
+    ("urn:X-tsbiot:rels:supports:query", "urn:X-tsbiot:query:openiot:v1"),
+    ("urn:X-1248:rels:location", "Cambridge"),
+    ("urn:X-1248:rels:manufacturer", "ACME")]
+
+def deepSize(obj, seen):
+    """Returns the size in bytes of <obj> and everything it refers to, excluding objects in <seen>"""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for (k, v) in obj.iteritems():
+            size += deepSize(k, seen) + deepSize(v, seen)
+    elif isinstance(obj, (list, tuple)):
+        for x in obj:
+            size += deepSize(x, seen)
+    elif isinstance(obj, (hypercat.Base, hypercat.Metadata)):
+        if hasattr(obj, "__dict__"):
+            size += deepSize(obj.__dict__, seen)
+        for cls in type(obj).__mro__:
+            for slot in cls.__dict__.get("__slots__", ()):
+                if hasattr(obj, slot):
+                    size += deepSize(getattr(obj, slot), seen)
+    return size
+
+def makeCatalogue(n):
+    """Returns a catalogue of <n> resources, each with all of RELS_PER_ITEM"""
+    h = hypercat.Hypercat("Benchmark catalogue")
+    for i in xrange(n):
+        r = hypercat.Resource("Meter "+str(i), "application/senml+json")
+        for (rel, val) in RELS_PER_ITEM:
+            r.addRelation(rel, val)
+        h.addItem(r, "http://example.com/meter/"+str(i))
+    return h
+
+def makeCatalogueJSON(n):
+    """Returns the JSON text of a catalogue of <n> resources"""
+    return makeCatalogue(n).asJSONstr()
+
+def itemsSize(cat):
+    """Size of just the items of a catalogue (given as a raw JSON object or a Hypercat), not counting their parent links"""
+    if isinstance(cat, dict):
+        items = cat[hypercat.ITEMS]
+    else:
+        items = list(cat.items)     # (Creating them all, if it was loaded lazily)
+    seen = set([id(cat)])
+    return deepSize(items, seen)
+
+def run(n):
+    s = makeCatalogueJSON(n)
+    results = [("raw JSON", itemsSize(json.loads(s)))]
+    for (name, compact) in [("normal", False), ("compact", True)]:
+        h = hypercat.loads(s, compact, lazy=True)
+        results.append((name, itemsSize(h)))
+        assert h.asJSONstr() == s   # (All the data is still there)
+    print "%d items, %d rels each" % (n, 2 + len(RELS_PER_ITEM))
+    for (name, size) in results:
+        print "  %-10s %12d bytes  %6d bytes/item  %5.1f%% of raw JSON" % (name, size, size/n, 100.0*size/results[0][1])
+    return results
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
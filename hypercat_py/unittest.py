@@ -103,6 +103,74 @@ def unittest():
     print hN.prettyprint()
     assert hN.values("name")[0] == "bottom"
 
+    print "Paths follow changes to the catalogue:"
+    assert h1.findByPath("name", "/nosuch") == None
+    h4 = hypercat.Hypercat("Other middle")
+    h4.addRelation("name","middle")
+    h1.addItem(h4, "http://FIXMEcat4")
+    assert h1.findByPath("name", "/middle") is h2    # The first item with a matching name wins
+    h2.replaceRelation("name","renamed")
+    assert h1.findByPath("name", "/middle") is h4
+    assert h1.findByPath("name", "/renamed/bottom") is h3
+    h5 = hypercat.Hypercat("Replacement")
+    h5.addRelation("name","middle")
+    h1.replaceItem(h5, "http://FIXMEcat2")
+    assert h1.findByPath("name", "/middle") is h5
+    assert h1.findByPath("name", "/renamed") == None
+    h3.addRelation("name","deepest")
+    assert h2.findByPath("name", "/deepest") is h3
+
+    print "Path indexes are updated in place, and only rebuilt if the first item with some val loses it:"
+    h = hypercat.Hypercat("paths")
+    for i in range(10):
+        r = hypercat.Resource("r"+str(i), "text/plain")
+        r.addRelation("name", "n"+str(i % 5))     # r5...r9 repeat the names of r0...r4
+        h.addItem(r, "http://r"+str(i))
+    assert h.findByPath("name", "n3") is h.items[3]
+    index = h._pathIndex["name"]
+    h.items[6].addRelation("name", "extra")
+    h.items[1].addRelation("name", "extra")
+    assert h._pathIndex["name"] is index and h.findByPath("name", "extra") is h.items[1]
+    fresh = hypercat.Resource("fresh", "text/plain")
+    fresh.addRelation("name", "fresh")
+    h.replaceItem(fresh, "http://r7")   # r7 was the first with none of its vals
+    assert h._pathIndex["name"] is index and h.findByPath("name", "fresh") is fresh and h.findByPath("name", "n2") is h.items[2]
+    h.items[4].replaceRelation("name", "n0")    # r4 was the first with n4
+    assert "name" not in h._pathIndex and h.findByPath("name", "n4") is h.items[9] and h.findByPath("name", "n0") is h.items[0]
+
+    print "\nTEST: Walk a hierarchy which shares catalogues and contains a loop"
+    top = hypercat.Hypercat("top")
+    a = hypercat.Hypercat("a")
+    b = hypercat.Hypercat("b")
+    shared = hypercat.Hypercat("shared")
+    top.addItem(a, "http://a")
+    top.addItem(b, "http://b")
+    top.addItem(hypercat.Resource("r", "text/plain"), "http://r")
+    a.addItem(shared, "http://shared")
+    b.addItem(shared, "http://shared")
+    shared.addItem(top, "http://top")  # Loop
+    names = lambda order, maxDepth=None: [(h.description(), d) for (h, d) in top.walk(maxDepth, order)]
+    assert names(hypercat.DEPTH_FIRST) == [("top",0), ("a",1), ("shared",2), ("b",1)]
+    assert names(hypercat.BREADTH_FIRST) == [("top",0), ("a",1), ("b",1), ("shared",2)]
+    assert names(hypercat.DEPTH_FIRST, 1) == [("top",0), ("a",1), ("b",1)]
+    deep = hypercat.Hypercat("deep")    # x is first reached at the depth limit, then again more directly, so y is within reach
+    (a, a2, x, y) = [hypercat.Hypercat(n) for n in ["a", "a2", "x", "y"]]
+    for (parent, child, href) in [(deep, a, "http://a"), (a, a2, "http://a2"), (a2, x, "http://x"), (deep, x, "http://x"), (x, y, "http://y")]:
+        parent.addItem(child, href)
+    for order in [hypercat.DEPTH_FIRST, hypercat.BREADTH_FIRST]:
+        walked = [(h.description(), d) for (h, d) in deep.walk(3, order)]
+        assert sorted(walked) == [("a",1), ("a2",2), ("deep",0), ("x",3 if order == hypercat.DEPTH_FIRST else 1), ("y",2)], walked
+    b.addItem(hypercat.Resource("r", "text/plain"), "http://r")
+    for order in [hypercat.DEPTH_FIRST, hypercat.BREADTH_FIRST]:    # Only catalogues need remembering: leaves are yielded once per parent
+        leaves = [h.href for (h, d) in hypercat.traverse(top, lambda h: h.items if isinstance(h, hypercat.Hypercat) else [],
+                                                         lambda h: id(h) if isinstance(h, hypercat.Hypercat) else None, order=order)
+                  if isinstance(h, hypercat.Resource)]
+        assert leaves == ["http://r", "http://r"], leaves
+    visited = []
+    top.recurse(lambda h, L: L.append(h.description()), visited)
+    assert visited == ["top", "a", "shared", "b"]
+    assert hypercat.canonicalHref("HTTP://Example.COM:80#frag") == hypercat.canonicalHref("http://example.com/")
+
     print "\nTEST: Create a fancy Catalogue with optional metadata"
     h2 = hypercat.Hypercat("Fancy Catalogue")
     h2.supportsSimpleSearch()
@@ -144,6 +212,114 @@ def unittest():
     assert h.values("relation") == ["value1","value2"]
     print h.prettyprint()
 
+    print "\nTEST: Replace a REL, keeping order and repeats"
+    h = hypercat.Hypercat("cat")
+    h.addRelation("relation","value1")
+    h.addRelation("other","x")
+    h.addRelation("relation","value2")
+    h.replaceRelation("relation","value3")
+    assert h.values("relation") == ["value3","value3"]
+    assert h.rels() == [hypercat.ISCONTENTTYPE_RELATION, hypercat.DESCRIPTION_RELATION, "relation", "other", "relation"]
+    assert h.asJSON()["item-metadata"][2:] == [{"rel":"relation","val":"value3"},{"rel":"other","val":"x"},{"rel":"relation","val":"value3"}]
+    h.values("relation").append("garbage")  # Returned list must be a copy
+    assert h.values("relation") == ["value3","value3"]
+    assert h.isCatalogue()
+    assert not hypercat.Resource("r", "text/plain").isCatalogue()
+
+    print "\nTEST: Add, bulk-add and replace items by href"
+    h = hypercat.Hypercat("cat")
+    h.addItem(hypercat.Resource("r0", "text/plain"), "http://r0")
+    h.addItems([(hypercat.Resource("r"+str(n), "text/plain"), "http://r"+str(n)) for n in range(1,4)])
+    assert [i.href for i in h.items] == ["http://r0","http://r1","http://r2","http://r3"]
+    try:
+        h.addItems([(hypercat.Resource("x", "text/plain"), "http://x"), (hypercat.Resource("r2", "text/plain"), "http://r2")])
+        assert False, "Duplicate href was accepted"
+    except AssertionError, e:
+        assert "unique" in str(e)
+    assert len(h.items) == 4    # Failed bulk add must not have added anything
+    other = hypercat.Hypercat("other")
+    other.addItem(hypercat.Resource("x", "text/plain"), "http://r1")
+    try:
+        other.addItem(h.items[0], "http://r1")
+        assert False, "Duplicate href was accepted"
+    except AssertionError, e:
+        assert "unique" in str(e)
+    assert h.items[0].href == "http://r0" and h.itemByHref("http://r0") is h.items[0]  # Failed add must not have changed the child
+    h.replaceItem(hypercat.Resource("new r2", "text/plain"), "http://r2")
+    assert h.itemByHref("http://r2").values(hypercat.DESCRIPTION_RELATION) == ["new r2"]
+    assert h.items[2].href == "http://r2"
+    assert h.itemByHref("http://nosuch") == None
+
+    print "\nTEST: Cached output and ETags follow changes to a catalogue and its items"
+    h = hypercat.Hypercat("cat")
+    r = hypercat.Resource("r", "text/plain")
+    h.addItem(r, "http://r")
+    s1 = h.asJSONstr()
+    e1 = h.etag()
+    assert (h.asJSONstr() is s1) and (h.etag() == e1)  # Second time round, from cache
+    r.addRelation("colour", "red")                      # Changing an item changes its parent's output
+    assert ("red" in h.asJSONstr()) and ("red" in h.prettyprint()) and (h.etag() != e1)
+    e2 = h.etag()
+    h.replaceItem(hypercat.Resource("r", "text/plain"), "http://r")
+    assert (h.asJSONstr() == s1) and (h.etag() == e1)   # ETags depend only on content
+    r.replaceRelation("colour", "blue")                 # r is no longer an item, so this doesn't affect h
+    assert h.etag() == e1
+    h.addRelation("colour", "green")
+    assert h.etag() not in [e1, e2]
+    assert "".join(h.iterencode()) == h.asJSONstr()
+
+    print "\nTEST: Compact resources behave exactly like normal ones"
+    for compact in [False, True]:
+        r = hypercat.Resource("r", "text/plain", compact=compact)
+        r.addRelation("relation","value1")
+        r.addRelation("other","x")
+        r.addRelation("relation","value2")
+        assert r.values("relation") == ["value1","value2"]
+        r.replaceRelation("relation","value3")
+        assert r.values("relation") == ["value3","value3"] and r.values("nosuch") == []
+        assert r.rels() == [hypercat.ISCONTENTTYPE_RELATION, hypercat.DESCRIPTION_RELATION, "relation", "other", "relation"]
+        assert len(r.metadata) == 5 and r.metadata[3] == {"rel":"other","val":"x"}
+        assert r.metadata[2:4] == [{"rel":"relation","val":"value3"}, {"rel":"other","val":"x"}] and r.metadata[-1:] == r.metadata.asJSON()[-1:]
+        assert not [m for m in ["append", "extend", "add", "replace", "__iadd__"] if hasattr(r.metadata, m)]   # Only changed via r, so caches can't go stale
+        if compact:
+            assert r.asJSON() == normal.asJSON() and r.metadata == normal.metadata
+        normal = r
+    try:
+        r.colour = "red"
+        assert False, "Resources should have no __dict__"
+    except AttributeError:
+        pass
+
+    print "\nTEST: Simple search"
+    h = hypercat.Hypercat("searchable")
+    h.supportsSimpleSearch()
+    for n in range(10):
+        r = hypercat.Resource("r"+str(n), "text/plain")
+        r.addRelation("parity", ["even","odd"][n % 2])
+        h.addItem(r, "http://r"+str(n))
+    def hrefs(cat): return [i.href for i in cat.items]
+    assert hrefs(h.search(rel="parity", val="odd")) == ["http://r1","http://r3","http://r5","http://r7","http://r9"]
+    assert hrefs(h.search(val="even", href="http://r4")) == ["http://r4"]
+    assert hrefs(h.search(val="even", href="http://r5")) == []
+    assert hrefs(h.search(rel="nosuch")) == []
+    assert len(h.search().items) == 10
+    h.addItem(hypercat.Resource("extra", "text/plain"), "http://extra")   # Index is kept up to date
+    assert hrefs(h.searchQuery("?rel=urn:X-tsbiot:rels:hasDescription:en&val=extra")) == ["http://extra"]
+    index = h._searchIndex
+    h.items[0].replaceRelation("parity", "odd")
+    assert hrefs(h.search(val="odd"))[0:2] == ["http://r0","http://r1"] and "http://r0" not in hrefs(h.search(val="even"))
+    h.items[2].addRelation("parity", "odd")     # Now both, so still found as even
+    assert hrefs(h.search(rel="parity", val="even"))[0] == "http://r2" and hrefs(h.search(val="odd"))[1] == "http://r1"
+    both = hypercat.Resource("r3", "text/plain")
+    both.addRelation("colour", "blue")
+    h.replaceItem(both, "http://r3")
+    assert hrefs(h.search(val="blue")) == ["http://r3"] and "http://r3" not in hrefs(h.search(rel="parity"))
+    assert h._searchIndex is index  # Changes are made to the index in place, rather than rebuilding it
+    fresh = hypercat._SearchIndex(h.items)
+    for by in ["byRel", "byVal", "byPair"]:
+        assert dict([(k, v) for (k, v) in getattr(index, by).items() if v]) == getattr(fresh, by), by
+    assert h.items[0]._parents == (h,)  # Search results don't take ownership of items
+
     print "\nTEST: Load a catalogue from a string"
     inString = """{
     "item-metadata": [
@@ -201,8 +377,220 @@ def unittest():
     h = hypercat.loads(inString)
     outString = h.prettyprint()
     assert inString == outString
+    assert hypercat.loads(inString, compact=True).prettyprint() == inString
     print inString
+
+    print "\nTEST: Load a catalogue incrementally from a stream"
+    import StringIO
+    h2 = hypercat.load(StringIO.StringIO(inString))
+    assert h2.prettyprint() == inString
+    events = list(hypercat.iterparse(StringIO.StringIO(h2.asJSONstr()), chunkSize=7)) # Tiny chunks, to exercise refilling
+    assert [k for (k,v) in events] == ["item-metadata", "items", "items", "items"]
+    assert events[3][1] == h2.items[2].asJSON()
+    it = hypercat.iterload(StringIO.StringIO(inString))
+    assert it.next().description() == "ingestiontestcat"
+    r = it.next()
+    assert (r.href == "http://FIXME") and r.isCatalogue()   # ...and we can stop reading here
+    reordered = """{"items":[{"href":"http://a","i-object-metadata":[{"rel":"urn:X-tsbiot:rels:isContentType","val":"t"},{"rel":"urn:X-tsbiot:rels:hasDescription:en","val":"a"}]}],"number":12345678,"item-metadata":[{"rel":"urn:X-tsbiot:rels:isContentType","val":"application/vnd.tsbiot.catalogue+json"},{"rel":"urn:X-tsbiot:rels:hasDescription:en","val":"cat"}]}"""
+    assert dict(hypercat.iterparse(StringIO.StringIO(reordered), chunkSize=5))["number"] == 12345678
+    L = list(hypercat.iterload(StringIO.StringIO(reordered), chunkSize=3))
+    assert (L[0].description() == "cat") and (L[1].href == "http://a")
+    try:
+        list(hypercat.iterparse(StringIO.StringIO(inString[:-10])))
+        assert False, "Truncated input was accepted"
+    except ValueError:
+        pass
+
+    print "\nTEST: Streamed output is identical to asJSONstr() and prettyprint()"
+    for cat in [h, hypercat.Hypercat(""), h1]:
+        assert "".join(cat.iterencode()) == cat.asJSONstr()
+        assert "".join(cat.iterencode(pretty=True)) == cat.prettyprint()
+        f = StringIO.StringIO()
+        cat.dump(f, pretty=True)
+        assert f.getvalue() == cat.prettyprint()
     
+    print "\nTEST: Save and load a binary snapshot of a hierarchy which shares catalogues and contains a loop"
+    import os, tempfile
+    top = hypercat.Hypercat("top")
+    shared = hypercat.Hypercat(u"shared \u00e9")
+    top.supportsSimpleSearch()
+    top.addItem(shared, "http://shared")
+    top.addItem(hypercat.Hypercat("other"), "http://other")
+    top.items[1].addItem(shared, "http://shared")
+    shared.addItem(top, "http://top")   # Loop
+    r = hypercat.Resource("meter", "application/senml+json")
+    r.addRelation("urn:X-senml:u", "J")
+    shared.addItem(r, "http://meter")
+    (fd, path) = tempfile.mkstemp(suffix=".snapshot")
+    os.close(fd)
+    try:
+        hypercat.saveSnapshot(top, path)
+        for compact in [False, True]:
+            top2 = hypercat.loadSnapshot(path, compact)
+            before = [c.prettyprint() for (c, depth) in top.walk()]
+            after = [c.prettyprint() for (c, depth) in top2.walk()]
+            assert before == after
+            assert top2.items[0] is top2.items[1].items[0]      # Still shared
+            assert top2.items[0].items[0] is top2               # Still a loop
+            assert top2.search("urn:X-senml:u").items == [] and top2.items[0].search("urn:X-senml:u").items[0].values("urn:X-senml:u") == ["J"]
+            top2.items[0].items[1].addRelation("urn:X-1248:rels:colour", "red")     # Changes still reach parents' output
+            assert "red" in top2.items[0].asJSONstr()
+            top2.addItem(hypercat.Resource("new", "text/plain"), "http://new")
+            assert top2.itemByHref("http://new").values(hypercat.DESCRIPTION_RELATION) == ["new"]
+    finally:
+        os.remove(path)
+
+    print "\nTEST: A catalogue shared under different hrefs is found by each of them after a snapshot is loaded"
+    a = hypercat.Hypercat("a")
+    b = hypercat.Hypercat("b")
+    via = hypercat.Hypercat("shared")
+    a.addItem(via, "http://via-a")
+    b.addItem(via, "http://via-b")
+    both = hypercat.Hypercat("both")
+    both.addItems([(a, "http://a"), (b, "http://b")])
+    (fd, path) = tempfile.mkstemp(suffix=".snapshot")
+    os.close(fd)
+    try:
+        hypercat.saveSnapshot(both, path)
+        for compact in [False, True]:
+            both2 = hypercat.loadSnapshot(path, compact)
+            (a2, b2) = both2.items
+            assert a2.itemByHref("http://via-a") is b2.itemByHref("http://via-b") is not None
+            assert a2.itemByHref("http://via-b") is None
+    finally:
+        os.remove(path)
+
+    print "\nTEST: Diff two versions of a catalogue, and apply the diff to the old one"
+    import json
+    def version(n):
+        h = hypercat.Hypercat("versioned")
+        if n == 2:
+            h.addRelation("urn:X-1248:rels:colour", "red")
+        for (i, href) in enumerate(["http://a", "http://b", "http://c", "http://d"] if n == 1 else ["http://b", "http://a", "http://c", "http://e"]):
+            if (n == 2) and (href == "http://c"):
+                c = hypercat.Hypercat("c is now a catalogue")
+            else:
+                c = hypercat.Resource("resource " + href, "text/plain")
+                if (n == 2) and (href == "http://a"):
+                    c.addRelation("urn:X-senml:u", "W")
+            h.addItem(c, href)
+        return h
+    (v1, v2) = (version(1), version(2))
+    d = hypercat.diff(v1, v2)
+    assert d.removed == ["http://d"] and [i["href"] for i in d.added] == ["http://e"]
+    assert [i["href"] for i in d.changed] == ["http://a", "http://c"] and d.metadata is not None
+    assert d.order == ["http://b", "http://a", "http://c", "http://e"]
+    assert len(hypercat.diff(v2, version(2))) == 0
+    for compact in [False, True]:
+        h = version(1)
+        if compact:
+            h = hypercat.loads(h.asJSONstr(), compact=True)
+        a = h.itemByHref("http://a")
+        hypercat.Diff(json.loads(json.dumps(d.asJSON()))).apply(h)   # As a subscriber would receive it
+        assert h.prettyprint() == v2.prettyprint()
+        assert h.itemByHref("http://a") is a    # Changed in place
+        assert h.itemByHref("http://c").isCatalogue() and h.search("urn:X-senml:u", "W").items == [a]
+    h = version(1)
+    h.removeItem("http://b")
+    assert [i.href for i in h.items] == ["http://a", "http://c", "http://d"] and h.itemByHref("http://d") is h.items[2]
+
+    print "\nTEST: Lazy loading keeps all metadata, and creates items (and fetches child catalogues) only when needed"
+    docs = {}
+    for (href, children) in [("http://root", ["http://x", "http://y"]), ("http://x", ["http://y"]), ("http://y", ["http://x", "http://r1"])]:
+        cat = hypercat.Hypercat("catalogue " + href)
+        for child in children:
+            c = hypercat.Resource("resource", "text/plain") if child == "http://r1" else hypercat.Hypercat("catalogue " + child)
+            c.addRelation("urn:X-1248:rels:colour", "red")
+            cat.addItem(c, child)
+        docs[href] = cat.asJSONstr()
+    fetched = []
+    def fetcher(href):
+        fetched.append(href)
+        return StringIO.StringIO(docs[href])
+    root = hypercat.loads(docs["http://root"], lazy=True, fetcher=fetcher)
+    assert root.asJSONstr() == docs["http://root"] and json.loads(root.prettyprint()) == json.loads(docs["http://root"])
+    assert fetched == [] and len(root.items) == 2
+    assert root.items[0].values("urn:X-1248:rels:colour") == ["red"]    # Not discarded
+    assert fetched == []    # Creating the child catalogue doesn't fetch it...
+    assert root.items[0].itemByHref("http://y") is root.items[1]    # ...using it does, and shared catalogues are fetched once
+    assert [h.href for (h, depth) in root.walk()] == [None, "http://x", "http://y"]     # The loop x->y->x is followed once
+    assert fetched == ["http://x", "http://y"]
+    assert root.items[1].items[1].values("urn:X-1248:rels:colour") == ["red"] and not root.items[1].items[1].isCatalogue()
+    assert root.items[1].items[1]._parents == (root.items[1],)
+    r = hypercat.Resource("new", "text/plain")
+    root.items[1].addItem(r, "http://r2")
+    assert root.items[1].asJSON()["items"][2]["href"] == "http://r2" and root.items[1].search(href="http://r2").items == [r]
+    failures = ["http://x"]
+    def flakyFetcher(href):
+        if href in failures:
+            failures.remove(href)
+            raise IOError("Unreachable")
+        return docs[href]
+    retried = hypercat.loads(docs["http://root"], lazy=True, fetcher=flakyFetcher)
+    try:
+        retried.items[0].itemByHref("http://y")
+        assert False, "Expected the fetch to fail"
+    except IOError:
+        pass
+    assert retried.items[0].itemByHref("http://y").href == "http://y"   # A failed fetch is tried again next time
+    retried.items[0].addItem(hypercat.Resource("new", "text/plain"), "http://r2")
+    assert [i.href for i in retried.items[0].items] == ["http://y", "http://r2"]
+    lazy = hypercat.loads(docs["http://y"], lazy=True)
+    assert lazy.asJSONstr() == docs["http://y"] and lazy.items[0].items == []   # No fetcher, so child catalogues have no items
+
+    print "\nTEST: Validate documents in one streaming pass, reporting every violation"
+    assert hypercat.validate(StringIO.StringIO(inString)) == []
+    assert hypercat.validate(StringIO.StringIO(h1.asJSONstr()), chunkSize=5) == []
+    bad = {"item-metadata" : [{"rel" : hypercat.DESCRIPTION_RELATION, "val" : u"caf\u00e9"}],
+           "items" : [
+                {"href" : "http://a", "i-object-metadata" : [{"rel" : hypercat.ISCONTENTTYPE_RELATION, "val" : "text/plain"}, {"rel" : hypercat.DESCRIPTION_RELATION, "val" : "a"}]},
+                {"href" : "http://a", "i-object-metadata" : [{"rel" : hypercat.ISCONTENTTYPE_RELATION, "val" : 5}, {"val" : "x"}]},
+                {"i-object-metadata" : {}},
+                "nonsense"]}
+    violations = hypercat.validate(StringIO.StringIO(json.dumps(bad)), chunkSize=16)
+    for x in violations:
+        print x.path, x.message
+    assert sorted([x.path for x in violations]) == sorted([
+        "/item-metadata/0/val", "/item-metadata", "/items/1/href", "/items/1/i-object-metadata/0/val", "/items/1/i-object-metadata/1",
+        "/items/1/i-object-metadata", "/items/2", "/items/2/i-object-metadata", "/items/3"])
+    assert len(hypercat.validate(StringIO.StringIO(json.dumps(bad)), maxViolations=2)) == 3     # ...and a note of how many more
+    assert [x.path for x in hypercat.validate(StringIO.StringIO(inString[:-30]))] == ["/items/2"]
+    assert [x.message for x in hypercat.validate(StringIO.StringIO('{"items":[]}'))] == ["has no item-metadata"]
+    for (doc, key) in [('{[1]:2,"items":[]}', '[1]'), ('{{"a":1}:2,"items":[]}', '{"a": 1}'), ('{5:2,"items":[]}', '5')]:   # Never raises, even on keys JSON doesn't allow
+        assert [x.message for x in hypercat.validate(StringIO.StringIO(doc))] == ["key " + key + " must be a string", "has no item-metadata"]
+    assert [(x.path, x.message) for x in hypercat.validate(StringIO.StringIO('{"items":5,"item-metadata":[]}'))] == [
+        ("/items", "must be an array"), ("/item-metadata", "has no " + hypercat.ISCONTENTTYPE_RELATION), ("/item-metadata", "has no " + hypercat.DESCRIPTION_RELATION)]
+    for doc in [inString + 'garbage', inString + inString]:
+        assert [(x.path, x.message) for x in hypercat.validate(StringIO.StringIO(doc))] == [("", "has more after the end of the document")]
+    assert [x.path for x in hypercat.validate(StringIO.StringIO('{"a/b~c":[1,}'))] == ["/a~1b~0c"]    # (Keys escaped as JSON Pointer requires)
+
+    print "\nTEST: Shard a big catalogue into child catalogues, by size and by key, and still find items by path"
+    big = hypercat.Hypercat("big")
+    for i in range(10):
+        r = hypercat.Resource("r%d" % i, "text/plain" if i % 3 else "application/senml+json")
+        r.addRelation("urn:X-1248:rels:name", "n%d" % i)
+        big.addItem(r, "http://r/%d" % i)
+    sharded = hypercat.shard(big, "http://cats/big", maxItems=4)
+    assert [s.href for s in sharded.items] == ["http://cats/bigp0", "http://cats/bigp1", "http://cats/bigp2"]
+    assert [len(s.items) for s in sharded.items] == [4, 4, 2] and sharded.metadata == big.metadata
+    assert sharded.items[1].items[0] is big.items[4] and sharded.items[1].itemByHref("http://r/4") is big.items[4]
+    assert sharded.findByPath("urn:X-1248:rels:name", "n9") is big.items[9] and sharded.findByPath("urn:X-1248:rels:name", "n10") is None
+    byType = hypercat.shard(big, "http://cats/big", maxItems=3, key=lambda i: i.values(hypercat.ISCONTENTTYPE_RELATION)[0])
+    names = [s.href[len("http://cats/big"):] for s in byType.items]
+    assert [len(s.items) for s in byType.items] == [3, 1, 3, 3] and all(n.isalnum() for n in names)
+    assert names[0].startswith("applicationsenmljson") and names[0].endswith("p0") and names[1] == names[0][:-1] + "1"
+    assert byType.findByPath("urn:X-1248:rels:name", "n6") is big.items[6]
+    before = [s.etag() for s in byType.items]
+    big.items[9].addRelation("urn:X-1248:rels:colour", "red")
+    again = hypercat.shard(big, "http://cats/big", maxItems=3, key=lambda i: i.values(hypercat.ISCONTENTTYPE_RELATION)[0])
+    assert [s.href for s in again.items] == [s.href for s in byType.items]
+    assert [e == s.etag() for (e, s) in zip(before, again.items)] == [True, False, True, True]   # Only r9's shard changed
+    byType.items[0].removeItem("http://r/0")
+    assert byType.findByPath("urn:X-1248:rels:name", "n0") is None and byType.findByPath("urn:X-1248:rels:name", "n3") is big.items[3]
+    for i in range(50):
+        hypercat.shard(big, "http://cats/big", maxItems=3)
+    assert [len(r._parents) for r in big.items] == [1] * 10     # Re-sharding doesn't leak the old shards
+
     print "\nUnit tests all passed OK"
 
 if __name__ == "__main__":
@@ -21,31 +21,79 @@
 # 1) Read a HyperCat API (http://www.openiot.org/apis)
 # 2) Crawl the hierarchy exhaustively looking for contents of a particular type
 #   (in this case Energy, a standard SenML type held in Joules)
-#   (limitation: Catalogues must form a closed hierarchy, not an open or cyclic graph)
+#   (Catalogues may be shared or form loops: each catalogue is visited only once)
 # 3) Return a ranked leaderboard of the previous day's results
+#   (or, keeping daily results in SQLite between runs, of the last N days)
 #
 
-import urllib2, base64, json, time
+import urllib, urllib2, urlparse, json, time, sys, threading, Queue, bisect, sqlite3, collections, heapq
+from hypercat_py import hypercat
+from transport_py import transport, metrics
 
 HYPERCAT_URL = "http://geras.1248.io/share/5ab6d8kw8t/armhome/cat"
 HYPERCAT_KEY = ">>INSERT_KEY_HERE<<"
 
-def loadJSON(uri, key=None):
-    # Loads a HyperCat catalogue from a remote server, as a JSON string
+MAX_WORKERS = 16    # Maximum number of requests in progress at once
+MAX_PER_HOST = 8    # ...of which at most this many to any one host
+
+# Connections are kept alive and reused. 60 seconds is max timeout allowed by GAE in foreground (but if testing locally we can get longer)
+TRANSPORT = transport.Transport(poolSize=MAX_PER_HOST, timeout=600)
+
+# Set this to a transport_py.cache.DiskCache to keep catalogues between runs, e.g.
+#   leaderboard.CACHE = cache.DiskCache("/tmp/leaderboard", ttl=86400)
+# Catalogue structure rarely changes, so a re-crawl then costs mostly 304s (or, within the ttl, no requests at all)
+CACHE = None
+
+def openURI(uri, key=None):
+    # Opens a HyperCat catalogue on a remote server, returning a file-like response
     # URI must be fully-specified, i.e. "https://fred.com/cat" or "http://127.0.0.1:9087/cat"
     # As per the HyperCat spec, the access <key>, if any, is passed as the Basic Auth username 
-    
-    if(key!=None):
-        # The following approach to constructing Basic Auth should work
-        # even if the site doesn't send back a 401 in response to a non-auth request
-        request = urllib2.Request(uri)
-        base64string = base64.encodestring(key+":"+"")[:-1]  # Remove trailing \n
-        request.add_header("Authorization", "Basic %s" % base64string)
-        f = urllib2.urlopen(request, timeout=600)    # 60 seconds is max timeout allowed by GAE in foreground (but if testing locally we can get longer)
-    else:
-        f = urllib2.urlopen(uri, timeout=600)
-        
-    return json.loads(f.read())
+    return TRANSPORT.get(uri, key)
+
+def loadJSON(uri, key=None):
+    # Loads a HyperCat catalogue from a remote server, as a JSON string
+    f = openURI(uri, key)
+    span = metrics.start("parse", url=uri)
+    result = json.load(f)
+    span.finish()
+    return result
+
+def openCatalogue(uri, key=None):
+    # As openURI(), but from the CACHE if there is one
+    if CACHE:
+        return CACHE.get(TRANSPORT, uri, key)
+    return openURI(uri, key)
+
+def loadItems(uri, key=None):
+    # Yields the items of a remote HyperCat catalogue one at a time, as they arrive,
+    # so we can start work before the whole catalogue has downloaded
+    span = metrics.start("catalogue", url=uri)
+    items = 0
+    f = openCatalogue(uri, key)
+    try:
+        for (k, item) in hypercat.iterparse(f):
+            if k == hypercat.ITEMS:
+                items += 1
+                yield item
+        f.read()    # Finish reading (any trailing whitespace), so the response can be cached and its connection reused
+    finally:
+        f.close()
+        span.finish(items=items)
+
+def readBeforeDescending(items):
+    # Passes through the items of a catalogue as they arrive, until the first child catalogue, then reads all the rest before
+    # passing that on. So a crawl never holds a response half-read (keeping its connection, and any cache file, open) while it
+    # crawls a subtree, which on a long crawl could take long enough for a server or proxy idle timeout to cut the response off.
+    # (Leaf catalogues, which hold the resources, are still streamed)
+    items = iter(items)
+    for item in items:
+        if isCatalogue(item):
+            rest = list(items)
+            yield item
+            for x in rest:
+                yield x
+            return
+        yield item
 
 CONTENT_TYPE_IS = 'urn:X-tsbiot:rels:isContentType'
 CATALOGUE = 'application/vnd.tsbiot.catalogue+json'
@@ -63,6 +111,9 @@ def hasRel(metadataList, rel, val):
     m = [ (x) for x in metadataList if x['rel']==rel and x['val']==val ]
     return m != []
 
+def isCatalogue(item):
+    return hasRel(item["i-object-metadata"], CONTENT_TYPE_IS, CATALOGUE)
+
 def isQueryable(metadata, datatype):
     # Does this Resource support time-series queries?
     return  (hasRel(metadata, CONTENT_TYPE_IS, SENML) and
@@ -77,43 +128,561 @@ def previousDay():
     end = start + 86400
     return (start,end)
 
+def previousDays(n):
+    # The <n> whole days up to and including previousDay(), oldest first
+    (start,end) = previousDay()
+    return [ (start - i*86400, end - i*86400) for i in reversed(range(n)) ]
+
+class SenMLSeries:
+    # A SenML time series, parsed once into a time-indexed structure
+    def __init__(self, senml):
+        bt = senml.get("bt", 0)     # Times are relative to the base time, if there is one
+        self.values = {}
+        for x in senml.get("e", []):
+            if "v" in x:
+                self.values[bt + x.get("t", 0)] = x["v"]
+        self.times = sorted(self.values)
+
+    def at(self, t):
+        # The value at exactly time t, or None
+        return self.values.get(t)
+
+    def nearest(self, t):
+        # The value at the time closest to t, or None if the series is empty
+        i = bisect.bisect_left(self.times, t)
+        candidates = self.times[max(i-1, 0):i+1]
+        if not candidates:
+            return None
+        return self.values[min(candidates, key=lambda x: abs(x-t))]
+
 def senmlValueAtTime(senml,t):
     # Extract the value of a SenML time series at a particular time
-    d = [ (x["v"]) for x in senml["e"] if x['t']==t ]
-    return d[0] if d else None
- 
+    return SenMLSeries(senml).at(t)
+
+def loadSeries(href, key, start, end):
+    # Get a time series as 1-hour rollups
+    return SenMLSeries(loadJSON(href+"?start="+str(start)+"&end="+str(end)+"&interval=1h&rollup=avg", key))
+
+# Fetch just the two hours we need, as two requests, rather than the whole day in one?
+# The OpenIoT query can't ask for both boundary hours at once, so this doubles the round-trips per meter, which costs
+# more than it saves on a latency-bound crawl. It's only worth it if the server is slow to produce a whole day's rollups.
+POINT_QUERIES = False
+
+STORE_PATH = "leaderboard.db"   # Where ResultsStore keeps daily results by default
+
 def getEnergySeries(href, key, metadata):
-    # Get the last 24 hours, as 1-hour rollups
-    (start,end) = previousDay()
-    data = loadJSON(href+"?start="+str(start)+"&end="+str(end)+"&interval=1h&rollup=avg", key)
-    # We asked for a full day of hours, but actually all we care about are Hour 0 and Hour 23
+    # Energy used by one meter over the previous day
+    return getEnergy(href, key, previousDay())
+
+def getEnergy(href, key, day):
+    (start,end) = day
+    # All we care about are Hour 0 and Hour 23 of the day
     # This is because we're dealing with Total-Energy-To-Date values, not Power values,
     # so what goes on between the last and first hour is irrelevant detail.
+    if POINT_QUERIES:
+        # So ask for just those two hours. If the server doesn't align its rollups exactly on the hour, take the nearest.
+        first = loadSeries(href, key, start, start+3600).nearest(start)
+        last = loadSeries(href, key, end-3600, end).nearest(end-3600)
+    else:
+        # Get the last 24 hours, as 1-hour rollups
+        day = loadSeries(href, key, start, end)
+        (first, last) = (day.at(start), day.at(end-3600))
     try:
-        kWh = (senmlValueAtTime(data, end-3600) - senmlValueAtTime(data, start)) / 3600000 # Convert a full day's consumption from Joules to kiloWatthours
-    except:
+        kWh = (last - first) / 3600000 # Convert a full day's consumption from Joules to kiloWatthours
+    except TypeError:   # One or other is missing
         kWh = None
     return (href, kWh)
 
-def crawl(url, key, datatype, fn):
-    # Returns a list of values resulting from calling <fn> on every queryable leaf
-    cat = loadJSON(url, key)
-    result = []
-    for (href,metadata) in map(lambda x: (x["href"],x["i-object-metadata"]), cat["items"]):
-        if hasRel(metadata, CONTENT_TYPE_IS, CATALOGUE):
-            result += crawl(href, key, datatype, fn)
-        else:   # Resource
+def supportsSearch(metadata):
+    return hasRel(metadata, hypercat.SUPPORTS_SEARCH_RELATION, hypercat.SUPPORTS_SEARCH_VAL)
+
+def mayContain(metadata, contentType):
+    # Might a catalogue with this metadata hold items of <contentType>? (Yes, unless it declares what it contains, and that isn't)
+    declared = [ x['val'] for x in metadata if x['rel'] == hypercat.CONTAINS_CONTENT_TYPE_RELATION ]
+    return (not declared) or (contentType in declared)
+
+def searchItems(uri, key, rel, val):
+    # Yields just those items of a catalogue which have relation <rel>=<val>, using HyperCat simple search
+    return loadItems(uri + ("&" if "?" in uri else "?") + urllib.urlencode([("rel", rel), ("val", val)]), key)
+
+def loadRelevantItems(uri, key, datatype, metadata=[]):
+    # Yields those items of the catalogue at <uri> which a crawl for <datatype> might need (at least its child catalogues and queryable resources)
+    # If the catalogue supports simple search, as declared in its own metadata or by its parent's <metadata> about it,
+    # we ask the server for just those, rather than transferring the whole catalogue.
+    # That's one search for child catalogues and one for resources, so it costs more requests than just reading the catalogue,
+    # unless the catalogue declares which content types it contains (then only the searches which can find anything are made)
+    if not supportsSearch(metadata):
+        f = openCatalogue(uri, key)
+        yielded = False
+        try:
+            for (k, v) in hypercat.iterparse(f):
+                if (k == hypercat.CATALOGUE_METADATA) and supportsSearch(v) and not yielded:
+                    metadata = v
+                    break   # Stop reading it, and search instead (unless its items came first, which searching would repeat)
+                if k == hypercat.ITEMS:
+                    yielded = True
+                    yield v
+            else:   # No search, so we've read the whole thing
+                f.read()
+                return
+        finally:
+            f.close()
+    # Simple search matches a single rel, so we search for the most selective condition and leave isQueryable() to check the rest
+    for (rel, val, contentType) in [ (CONTENT_TYPE_IS, CATALOGUE, CATALOGUE), (SENML_UNITS_IS, datatype, SENML) ]:
+        if not mayContain(metadata, contentType):
+            continue
+        results = searchItems(uri, key, rel, val)
+        try:
+            first = next(results, None)
+        except urllib2.HTTPError:   # Search turns out not to work here after all, so walk it (items already seen are skipped)
+            for item in loadItems(uri, key):
+                yield item
+            return
+        if first is not None:
+            yield first
+            for item in results:
+                yield item
+
+def walk(url, key, maxDepth=None, order=hypercat.DEPTH_FIRST, datatype=None, pool=None):
+    # Yields (href, metadata, depth) for every item reachable from the catalogue at <url>
+    # Each catalogue is visited once only, even if shared or in a loop, but a resource listed in several catalogues is yielded
+    # once for each, since only catalogue hrefs are remembered (so memory grows with the number of catalogues, not resources)
+    # If <datatype> is given, catalogues which support search are searched for the items relevant to it, and other items may be skipped
+    # If a _Pool is given, catalogues are fetched on it, a bounded number ahead of the walk, in the order the walk will want them
+    def fetch(item):
+        if datatype is not None:
+            return loadRelevantItems(item["href"], key, datatype, item["i-object-metadata"])
+        return loadItems(item["href"], key)
+    if pool:
+        prefetcher = _Prefetcher(pool, lambda item: list(fetch(item)), order)
+    def children((item, depth)):
+        if not isCatalogue(item):
+            return []
+        if not pool:
+            items = readBeforeDescending(fetch(item))
+        else:
+            items = prefetcher.take(item)
+            if (maxDepth is None) or (depth+1 < maxDepth):  # (Child catalogues which won't be expanded needn't be fetched)
+                prefetcher.expect([x for x in items if isCatalogue(x)])
+        return ( (x, depth+1) for x in items )
+    def catalogueKey((item, depth)):
+        return hypercat.canonicalHref(item["href"]) if isCatalogue(item) else None
+    root = { "href" : url, "i-object-metadata" : [ { "rel" : CONTENT_TYPE_IS, "val" : CATALOGUE } ] }
+    for ((item, depth), d) in hypercat.traverse((root, 0), children, catalogueKey, maxDepth, order):
+        if depth > 0:
+            if metrics.enabled() and isCatalogue(item):
+                metrics.record("crawl.catalogue", url=item["href"], depth=depth)
+            yield (item["href"], item["i-object-metadata"], depth)
+
+# The crawl is a pipeline of generators: discover -> filter -> fetch & score,
+# so that results appear while the crawl is still running, and memory doesn't grow with the number of resources
+
+def discover(url, key, maxDepth=None, order=hypercat.DEPTH_FIRST, datatype=None, pool=None):
+    # Yields (href, metadata) for every resource (not catalogue) reachable from the catalogue at <url>
+    # (or if <datatype> is given, at least those of that datatype, searching for them where catalogues support search)
+    for (href,metadata,depth) in walk(url, key, maxDepth, order, datatype, pool):
+        if not hasRel(metadata, CONTENT_TYPE_IS, CATALOGUE):
+            yield (href, metadata)
+
+def icrawl(url, key, datatype, fn, maxWorkers=1, maxPerHost=MAX_PER_HOST, maxDepth=None, order=hypercat.DEPTH_FIRST, pushdown=False):
+    # Yields the values resulting from calling <fn> on every queryable leaf, in order, as they become available
+    # With <maxWorkers> > 1, catalogues are fetched and <fn> called on that many threads at once (at most <maxPerHost> to any one host),
+    # a bounded distance ahead of the consumer, and the results are still in order
+    # With <pushdown>, catalogues which support search are asked for just the relevant items (which may change the order)
+    def leaves(pool):
+        for (href, metadata) in discover(url, key, maxDepth, order, datatype if pushdown else None, pool):
             if isQueryable(metadata, datatype):
-                result += [fn(href, key, metadata)]
-    return result
+                yield (href, metadata)
+    if metrics.enabled():
+        fn = _timed(fn)
+    if maxWorkers <= 1:
+        for (href, metadata) in leaves(None):
+            yield fn(href, key, metadata)
+        return
+    pool = _Pool(maxWorkers, maxPerHost)
+    try:
+        pending = collections.deque()
+        for (href, metadata) in leaves(pool):
+            pending.append(pool.submit(href, fn, href, key, metadata))
+            if len(pending) >= 2*maxWorkers:    # Enough to keep the workers busy
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        pool.close()
+
+def _timed(fn):
+    # <fn>, reporting each call as a "score" span
+    def timed(href, key, metadata):
+        span = metrics.start("score", url=href)
+        try:
+            return fn(href, key, metadata)
+        finally:
+            span.finish()
+    return timed
+
+def crawl(url, key, datatype, fn, maxDepth=None, order=hypercat.DEPTH_FIRST, pushdown=False):
+    # Returns a list of values resulting from calling <fn> on every queryable leaf
+    return list(icrawl(url, key, datatype, fn, maxDepth=maxDepth, order=order, pushdown=pushdown))
+
+class _Future:
+    # The eventual result of a call made on a _Pool
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+    def set(self, value, error=None):
+        (self.value, self.error) = (value, error)
+        self.done.set()
+
+    def result(self):
+        while not self.done.wait(1.0):  # (A wait with no timeout can't be interrupted by Ctrl-C)
+            pass
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+class _Pool:
+    # A pool of worker threads, running at most <maxPerHost> calls at once against any one host
+    def __init__(self, maxWorkers, maxPerHost):
+        self.maxWorkers = maxWorkers
+        self.maxPerHost = maxPerHost
+        self.hostLimits = {}
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.closed = False
+        self.threads = [threading.Thread(target=self._work) for i in range(maxWorkers)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def submit(self, url, fn, *args):
+        # Calls fn(*args) on a worker, when <url>'s host has capacity, returning a _Future
+        future = _Future()
+        self.queue.put((future, urlparse.urlparse(url).netloc, fn, args))
+        return future
+
+    def _hostLimit(self, host):
+        with self.lock:
+            if host not in self.hostLimits:
+                self.hostLimits[host] = threading.BoundedSemaphore(self.maxPerHost)
+            return self.hostLimits[host]
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            (future, host, fn, args) = task
+            if self.closed:     # Abandoned, e.g. because the caller has already failed
+                future.set(None)
+                continue
+            with self._hostLimit(host):
+                try:
+                    future.set(fn(*args))
+                except:
+                    future.set(None, sys.exc_info())
+
+    def close(self):
+        # Abandons any work not yet started, waits for work in progress, then stops the workers
+        self.closed = True
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+class _Prefetcher:
+    # Fetches catalogues on a _Pool ahead of a walk: those it's told to expect, in the order the walk will want them,
+    # at most 2*maxWorkers at a time (so a huge catalogue tree doesn't flood the pool, or memory)
+    def __init__(self, pool, fetch, order):
+        self.pool = pool
+        self.fetch = fetch
+        self.depthFirst = (order == hypercat.DEPTH_FIRST)
+        self.waiting = collections.deque()  # (canonical href, item) of catalogues expected but not yet fetching, next wanted first
+        self.fetching = {}  # canonical href -> _Future
+        self.started = set()    # canonical hrefs of all catalogues ever expected or taken, so none is fetched twice
+
+    def expect(self, items):
+        # <items> are child catalogues just found by the walk, in order. Depth-first, they're wanted before any found earlier
+        new = []
+        for item in items:
+            k = hypercat.canonicalHref(item["href"])
+            if k not in self.started:
+                self.started.add(k)
+                new.append((k, item))
+        if self.depthFirst:
+            self.waiting.extendleft(reversed(new))
+        else:
+            self.waiting.extend(new)
+        self._fill()
+
+    def _fill(self):
+        while self.waiting and (len(self.fetching) < 2*self.pool.maxWorkers):
+            (k, item) = self.waiting.popleft()
+            if k not in self.fetching:
+                self.fetching[k] = self.pool.submit(item["href"], self.fetch, item)
+
+    def take(self, item):
+        # Returns the fetched items of catalogue <item>, waiting for them (or fetching them now, if not expected) as necessary
+        k = hypercat.canonicalHref(item["href"])
+        future = self.fetching.pop(k, None)
+        if future is None:
+            self.started.add(k)
+            self.waiting = collections.deque([ (x, i) for (x, i) in self.waiting if x != k ])
+            future = self.pool.submit(item["href"], self.fetch, item)
+        self._fill()    # (Keep the pool busy while we wait)
+        return future.result()
+
+def crawlConcurrently(url, key, datatype, fn, maxWorkers=MAX_WORKERS, maxPerHost=MAX_PER_HOST, maxDepth=None):
+    # As crawl(), returning the same list in the same order, but fetching catalogues and calling <fn> on up to <maxWorkers> threads at once
+    return list(icrawl(url, key, datatype, fn, maxWorkers, maxPerHost, maxDepth))
+
+class ResultsStore:
+    # Per-meter daily kWh results, kept in SQLite between runs, so that past days never need fetching again
+    def __init__(self, path=STORE_PATH):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS daily (href TEXT NOT NULL, day INTEGER NOT NULL, kWh REAL, PRIMARY KEY (href, day))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS daily_by_day ON daily (day)")
+
+    def record(self, results):
+        # <results> is a list of (href, day, kWh), where day is (start,end)
+        # A kWh of None (no data, perhaps only because it hasn't arrived yet) isn't recorded, so that it's asked for again next time
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO daily (href, day, kWh) VALUES (?,?,?)",
+                [ (href, day[0], kWh) for (href, day, kWh) in results if kWh is not None ])
+
+    def recordAll(self, results, batchSize=1000):
+        # Records a stream of (href, day, kWh) results in batches as they arrive, so an interrupted run keeps what it's done
+        batch = []
+        try:
+            for r in results:
+                batch.append(r)
+                if len(batch) >= batchSize:
+                    self.record(batch)
+                    batch = []
+        finally:
+            self.record(batch)
+
+    def recording(self, results, day, batchSize=1000):
+        # Passes through a stream of (href, kWh) results for <day>, recording them as they go by
+        batch = []
+        for (href, kWh) in results:
+            batch.append((href, day, kWh))
+            if len(batch) >= batchSize:
+                self.record(batch)
+                batch = []
+            yield (href, kWh)
+        self.record(batch)
+
+    def missing(self, hrefs, days):
+        # Returns those (href, day) for which we have no result yet
+        with self.lock:
+            have = set(self.db.execute("SELECT href, day FROM daily WHERE day BETWEEN ? AND ? AND kWh IS NOT NULL", (days[0][0], days[-1][0])))
+        return [ (href, day) for day in days for href in hrefs if (href, day[0]) not in have ]
+
+    def top(self, days, k=None, hrefContains=""):
+        # Returns [(href, total kWh)] for meters with valid results on all <days>, highest first (at most <k> of them)
+        starts = [ day[0] for day in days ]
+        query = ("SELECT href, SUM(kWh) AS total FROM daily WHERE day IN (" + ",".join("?" * len(starts)) + ") AND href LIKE ? "
+                 "GROUP BY href HAVING COUNT(kWh) = ? AND total != 0 ORDER BY total DESC LIMIT ?")
+        with self.lock:
+            return self.db.execute(query, starts + ["%" + hrefContains + "%", len(starts), -1 if k is None else k]).fetchall()
+
+def formatLeaderboard(L):
+    # Pluck just the ARM Home number from the long HREF string, and round kWh to 2 decimal places
+    return [ (x[0].split("home/")[1].split("/")[0], "%0.2f" % x[1]) for x in L ]
+
+def getLeaderboard(maxWorkers=MAX_WORKERS, maxPerHost=MAX_PER_HOST, store=None, k=None, pushdown=True):
+    # The previous day's leaderboard (top <k> only, if given). If a ResultsStore is given, the results are also recorded in it.
+    # With pushdown, catalogues which support search send only their child catalogues and energy meters, saving transfer on big ones,
+    # but at the cost of up to two searches per catalogue (plus a wasted request for any whose search only it declares, not its parent)
+    # instead of one read, unless catalogues declare which content types they contain. Turn it off (<pushdown>=False) if the catalogues are small.
+    L = icrawl(HYPERCAT_URL, HYPERCAT_KEY, ENERGY, getEnergySeries, maxWorkers, maxPerHost, pushdown=pushdown)
+    if store:
+        L = store.recording(L, previousDay())
+    L = ( (x) for x in L if "MeterReader" in x[0] and x[1] and x[1]!= 0 ) # Keep only Meter Readers with valid values
+    if k is None:
+        L = sorted(L, key = lambda x : x[1], reverse=True)    # Sort on Energy, highest first
+    else:
+        L = heapq.nlargest(k, L, key = lambda x : x[1])     # ...keeping only the top k as we go
+    return formatLeaderboard(L)
+
+def getPeriodLeaderboard(nDays, store, k=None, maxWorkers=MAX_WORKERS, maxPerHost=MAX_PER_HOST):
+    # The leaderboard for the total over the last <nDays> whole days (e.g. 7 for weekly), top <k> only.
+    # Only results missing from the ResultsStore <store> are fetched; the ranking itself is answered by the store.
+    days = previousDays(nDays)
+    hrefs = [ href for href in icrawl(HYPERCAT_URL, HYPERCAT_KEY, ENERGY, lambda href, key, metadata: href, maxWorkers, maxPerHost)
+              if "MeterReader" in href ]
+    store.recordAll(fetchEnergy(store.missing(hrefs, days), HYPERCAT_KEY, maxWorkers, maxPerHost))
+    return formatLeaderboard(store.top(days, k, "MeterReader"))
+
+def fetchEnergy(meterDays, key, maxWorkers=MAX_WORKERS, maxPerHost=MAX_PER_HOST):
+    # Yields (href, day, kWh) for each (href, day) of <meterDays>, fetching up to <maxWorkers> at once, a bounded distance ahead
+    # A fetch which fails is reported and skipped, so one meter's failure doesn't lose everyone else's results
+    def result(href, day, future):
+        try:
+            return [ (href, day, future.result()[1]) ]
+        except Exception, e:
+            sys.stderr.write("Failed to get energy for %s on day %d: %s\n" % (href, day[0], e))
+            return []
+    pool = _Pool(maxWorkers, maxPerHost)
+    try:
+        pending = collections.deque()
+        for (href, day) in meterDays:
+            pending.append((href, day, pool.submit(href, getEnergy, href, key, day)))
+            if len(pending) >= 2*maxWorkers:
+                for r in result(*pending.popleft()):
+                    yield r
+        while pending:
+            for r in result(*pending.popleft()):
+                yield r
+    finally:
+        pool.close()
+
+### Unit tests ###
+
+def unittest():
+    # Runs against a local stand-in Pathfinder server, so needs no network
+    from pathfinder_py import pathfinder_server
+    global openCatalogue, getEnergy, POINT_QUERIES, HYPERCAT_URL, HYPERCAT_KEY   # (Replaced during some tests)
+
+    print "Running tests"
+    server = pathfinder_server.PathfinderServer(key="SECRET").start()
+    root = server.addSyntheticTree(depth=2, fanout=3, meters=4)
+    try:
+        print "A crawl never holds a catalogue half-read while it crawls below it"
+        opened = [0, 0]     # Catalogues being requested or read now, and most at once
+        openedLock = threading.Lock()
+        class Counted:
+            def __init__(self, uri, key=None):
+                with openedLock:
+                    opened[0] += 1
+                    opened[1] = max(opened)
+                (self.f, self.open) = (realOpenCatalogue(uri, key), True)
+            def read(self, *args):
+                return self.f.read(*args)
+            def close(self):
+                with openedLock:
+                    if self.open:
+                        self.open = False
+                        opened[0] -= 1
+                self.f.close()
+        realOpenCatalogue = openCatalogue
+        openCatalogue = Counted
+        try:
+            walked = list(walk(root, "SECRET"))
+        finally:
+            openCatalogue = realOpenCatalogue
+        assert len(walked) == 3 + 9 + 9*4 and [d for (h, m, d) in walked][:3] == [1, 2, 3]
+        assert opened == [0, 1], opened
+
+        print "A concurrent crawl fetches catalogues several at once, and gives the same results in the same order"
+        server.latency = 0.02   # (So that fetches overlap)
+        openCatalogue = Counted
+        try:
+            for order in [hypercat.DEPTH_FIRST, hypercat.BREADTH_FIRST]:
+                hrefs = crawl(root, "SECRET", ENERGY, lambda href, key, metadata: href, order=order)
+                opened[:] = [0, 0]
+                assert list(icrawl(root, "SECRET", ENERGY, lambda href, key, metadata: href, maxWorkers=4, order=order)) == hrefs
+                assert len(hrefs) == 36 and opened[0] == 0 and opened[1] > 1, (len(hrefs), opened)
+        finally:
+            (openCatalogue, server.latency) = (realOpenCatalogue, 0.0)
+
+        print "With metrics on, a crawl reports a span for each request, catalogue and resource scored"
+        a = metrics.Aggregator()
+        metrics.addHook(a)
+        try:
+            crawl(root, "SECRET", ENERGY, lambda href, key, metadata: href)
+        finally:
+            metrics.removeHook(a)
+        s = a.summary()
+        assert s["http"]["status=200"]["count"] == s["catalogue"]["items"]["count"] == 13 and s["catalogue"]["items"]["total"] == 3 + 9 + 36
+        assert s["crawl.catalogue"]["depth"]["count"] == 12 and s["score"]["seconds"]["count"] == 36, s
+
+        print "Pushing the search down to catalogues which support it finds the same meters as a plain crawl"
+        searchable = server.addSyntheticTree(depth=2, fanout=3, meters=4, search=True, name="searchable")
+        (results, requests) = ({}, {})
+        for pushdown in [False, True]:
+            before = server.requests["GET"]
+            results[pushdown] = sorted(crawl(searchable, "SECRET", ENERGY, lambda href, key, metadata: href, pushdown=pushdown))
+            requests[pushdown] = server.requests["GET"] - before
+        print "(%d requests for a plain crawl, %d with pushdown)" % (requests[False], requests[True])
+        assert len(results[True]) == 36 and results[True] == results[False]
+        assert sorted(icrawl(searchable, "SECRET", ENERGY, lambda href, key, metadata: href, maxWorkers=4, pushdown=True)) == results[False]
+        assert requests[True] == requests[False] + 1, requests   # (The root only declares search itself, so is opened before it's searched)
+
+        print "...even if a catalogue's items come before its own metadata says it supports search"
+        h = hypercat.Hypercat("Items first")
+        h.supportsSimpleSearch()
+        for n in range(3):
+            r = hypercat.Resource("Meter " + str(n), SENML)
+            r.addRelation(SENML_UNITS_IS, ENERGY)
+            r.addRelation(SUPPORTS_QUERY, OPENIOT)
+            h.addItem(r, server.url + "/home/" + str(n) + "/MeterReader")
+        doc = json.loads(h.asJSONstr())
+        TRANSPORT.request("POST", server.url + "/cats/itemsfirst", "SECRET",
+            '{"items":' + json.dumps(doc["items"]) + ',"item-metadata":' + json.dumps(doc["item-metadata"]) + '}').read()
+        for pushdown in [False, True]:
+            assert len(crawl(server.url + "/cats/itemsfirst", "SECRET", ENERGY, lambda href, key, metadata: href, pushdown=pushdown)) == 3
+
+        print "Pushdown can be turned off for the leaderboard, with the same result"
+        (realURL, realKey) = (HYPERCAT_URL, HYPERCAT_KEY)
+        (HYPERCAT_URL, HYPERCAT_KEY) = (searchable, "SECRET")
+        try:
+            L = getLeaderboard(maxWorkers=4, pushdown=False)
+            assert len(L) == 36 and getLeaderboard(maxWorkers=4) == L
+        finally:
+            (HYPERCAT_URL, HYPERCAT_KEY) = (realURL, realKey)
+
+        print "A meter's energy for a day costs one request (or two, with point queries), with the same result either way"
+        day = previousDay()
+        expected = pathfinder_server.meterEnergy(5, day[1]-3600) - pathfinder_server.meterEnergy(5, day[0])
+        realPointQueries = POINT_QUERIES
+        for (pointQueries, requests) in [(False, 1), (True, 2)]:
+            POINT_QUERIES = pointQueries
+            before = server.requests["GET"]
+            try:
+                (href, kWh) = getEnergy(server.url + "/home/5/MeterReader", "SECRET", day)
+            finally:
+                POINT_QUERIES = realPointQueries
+            assert kWh == expected / 3600000 and server.requests["GET"] == before + requests, (kWh, server.requests)
+
+        print "A period leaderboard keeps what it can get, and next time asks only for what failed or had no data yet"
+        (realURL, realKey, realGetEnergy) = (HYPERCAT_URL, HYPERCAT_KEY, getEnergy)
+        (HYPERCAT_URL, HYPERCAT_KEY) = (root, "SECRET")
+        days = previousDays(2)
+        def flaky(href, key, day):
+            if "/home/0/" in href:
+                raise urllib2.HTTPError(href, 500, "Broken", {}, None)
+            if ("/home/1/" in href) and (day == days[-1]):
+                return (href, None)     # (No data yet)
+            return realGetEnergy(href, key, day)
+        store = ResultsStore(":memory:")
+        try:
+            getEnergy = flaky
+            L = getPeriodLeaderboard(2, store, maxWorkers=4)
+            assert len(L) == 36 - 2 and "0" not in [n for (n, kWh) in L] and "1" not in [n for (n, kWh) in L]
+            getEnergy = realGetEnergy
+            before = server.requests["GET"]
+            L = getPeriodLeaderboard(2, store, maxWorkers=4)
+            assert len(L) == 36 and server.requests["GET"] == before + 13 + 3     # (Catalogues, then just the three missing meter-days)
+        finally:
+            (HYPERCAT_URL, HYPERCAT_KEY, getEnergy) = (realURL, realKey, realGetEnergy)
+    finally:
+        TRANSPORT.close()   # (so the server's keep-alive threads finish)
+        server.stop()
+    print "All tests passed"
 
-def getLeaderboard():
-    L = crawl(HYPERCAT_URL, HYPERCAT_KEY, ENERGY, getEnergySeries)
-    L = [ (x) for x in L if "MeterReader" in x[0] and x[1] and x[1]!= 0 ] # Keep only Meter Readers with valid values
-    L.sort(key = lambda x : x[1], reverse=True)    # Sort on Energy, highest first
-    L = [ (x[0].split("home/")[1].split("/")[0], "%0.2f" % x[1]) for x in L ] # Pluck just the ARM Home number from the long HREF string, and round kWh to 2 decimal places
-    return L    
-    
 if __name__ == '__main__':
-    gL = getLeaderboard()
+    # Usage: leaderboard.py [days]   (with <days>, results are kept in STORE_PATH and the leaderboard covers that many days)
+    #    or: leaderboard.py test
+    if sys.argv[1:] == ["test"]:
+        unittest()
+        sys.exit(0)
+    if len(sys.argv) > 1:
+        gL = getPeriodLeaderboard(int(sys.argv[1]), ResultsStore())
+    else:
+        gL = getLeaderboard()
     print json.dumps(gL, indent=4, separators=(',', ': '))
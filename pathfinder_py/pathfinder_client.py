@@ -27,11 +27,18 @@
 ##    Create a Catalogue object
 ##    Write it to a Pathfinder instance
 ##    Delete it
+## Or:
+##    Publish a whole hierarchy of catalogues with a Publisher, which uploads only those that have changed
 
-import urllib
-import base64
+import os
+import json
+import Queue
 import logging
-import urllib2  # Warning - outside of GAE, this doesn't check HTTPS certs (the better "Requests" alternative module does, but doesn't yet run in GAE)
+import threading
+try:
+    from ..transport_py import transport    # When used as part of the Tools package
+except (ValueError, ImportError):
+    from transport_py import transport      # When Tools itself is on the path
 
 # Pushes HyperCat catalogues to Pathfinder instances
 # Catalogue URLs are arbitrary (i.e. they do not reflect the hierarchy/structure of the catalogue if any -
@@ -44,22 +51,23 @@ import urllib2  # Warning - outside of GAE, this doesn't check HTTPS certs (the
 
 # TEST_URL = "https://posttestserver.com/post.php"   # Rather useful tool for debugging what we're POSTing!
 
+# Connections to each Pathfinder instance are kept alive and reused between calls
+TRANSPORT = transport.Transport()
+
 def getPage(url, key, payload=None, delete=False):
-    logging.info("Posting to catalogue "+url+" with key "+str(key)+" and payload "+str(payload)+" and delete "+str(delete))
+    # (Log the payload's size, not the payload itself, which can be huge. Timings are reported through transport_py.metrics)
+    logging.info("Posting to catalogue %s with key %s and payload of %d bytes and delete %s", url, key, len(payload or ""), delete)
     if(key!=None):
-        # The following approach to constructing Basic Auth should work
-        # even if the site doesn't send back a 401 in response to a non-auth request
-        request = urllib2.Request(url)
-        authstr = "Basic %s" % base64.encodestring(key+":")[:-1]    # key is passed as username in "username:password". Remove trailing \n
-        request.add_header("Authorization", authstr)
-        request.add_header("Content-Type", "application/json")
-        if(payload):
-            request.add_data(payload) # automatically changes request-type to POST
+        # key is passed as the Basic Auth username
         if(delete):
-            request.get_method = lambda: 'DELETE'
-        f = urllib2.urlopen(request) # Unfortunately, outside GAE urllib2 does NOT validate HTTPS certs, and within GAE it now ALWAYS validates certs!
+            method = "DELETE"
+        elif(payload):
+            method = "POST"
+        else:
+            method = "GET"
+        f = TRANSPORT.request(method, url, key, payload, {"Content-Type" : "application/json"})
     else:
-        f = urllib2.urlopen(url)
+        f = TRANSPORT.get(url)
     return f.read()
 
 
@@ -87,22 +95,113 @@ class Catalogue:
     def get(self):
         """Reads this catalogue entry from the Pathfinder instance"""
         body = getPage(self.url, self.key)
-        logging.info("Body in get was '"+body+"'")
+        logging.info("Body in get was %d bytes", len(body))
         return body
 
 
+# Results of publishing each catalogue
+UNCHANGED = "unchanged"
+CREATED = "created"
+FAILED = "failed"
+
+def _concurrently(fn, args, maxWorkers):
+    """Calls fn(arg) for each of <args> on up to <maxWorkers> threads, returning the results in order"""
+    results = [None] * len(args)
+    queue = Queue.Queue()
+    for i in enumerate(args):
+        queue.put(i)
+    def work():
+        while True:
+            try:
+                (i, arg) = queue.get_nowait()
+            except Queue.Empty:
+                return
+            results[i] = fn(arg)
+    threads = [threading.Thread(target=work) for i in range(min(maxWorkers, len(args)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def _normalised(body):
+    """A catalogue as returned by Pathfinder, formatted as hypercat.asJSONstr() would"""
+    return json.dumps(json.loads(body), sort_keys=True, separators=(',', ':'))
+
+class Publisher:
+    """Publishes a whole hierarchy of hypercat catalogues to a Pathfinder instance, several at once,
+    uploading only those catalogues which differ from what's already there"""
+    def __init__(self, key, maxWorkers=8, manifestPath=None):
+        """If <manifestPath> is given, a local manifest of what was last published is kept there and trusted
+        (saving a GET per catalogue), otherwise each catalogue is compared with what's on the server"""
+        self.key = key
+        self.maxWorkers = maxWorkers
+        self.manifestPath = manifestPath
+        self.lock = threading.Lock()
+
+    def _loadManifest(self):
+        if self.manifestPath and os.path.exists(self.manifestPath):
+            with open(self.manifestPath) as f:
+                return json.load(f)     # url -> etag
+        return {}
+
+    def _saveManifest(self, manifest):
+        with open(self.manifestPath + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        os.rename(self.manifestPath + ".tmp", self.manifestPath)
+
+    def _unchanged(self, url, h, manifest):
+        if self.manifestPath:
+            return manifest.get(url) == h.etag()
+        try:
+            return _normalised(Catalogue(url, self.key).get()) == h.asJSONstr()
+        except Exception:
+            return False    # Probably doesn't exist yet
+
+    def _publishOne(self, (url, h), manifest):
+        if self._unchanged(url, h, manifest):
+            return (url, UNCHANGED, None)
+        try:
+            Catalogue(url, self.key).create(h)
+        except Exception, e:
+            logging.warning("Failed to publish catalogue "+url+": "+repr(e))
+            return (url, FAILED, repr(e))
+        with self.lock:
+            manifest[url] = h.etag()
+        return (url, CREATED, None)
+
+    def publish(self, h, url):
+        """Publishes catalogue <h> at <url>, and each catalogue below it at its href (each once only, even if shared).
+        Returns a list of (url, UNCHANGED/CREATED/FAILED, error) for each catalogue"""
+        targets = [ (url if depth == 0 else c.href, c) for (c, depth) in h.walk() ]
+        manifest = self._loadManifest()
+        results = _concurrently(lambda target: self._publishOne(target, manifest), targets, self.maxWorkers)
+        if self.manifestPath:
+            self._saveManifest(manifest)
+        return results
+
+
 ### Unit tests ###
     
 TEST_PATHFINDER_URL_ROOT = "https://dev.1248.io:8002/cats/1248cat"
 
-def unittest():
+def unittest(live=False):
+    """Runs against a local stand-in Pathfinder server, or (if <live>) the real one at TEST_PATHFINDER_URL_ROOT"""
+    import urllib2
     from ..hypercat_py import hypercat  # Python only allows this if we've been called as a package. I don't understand why!
+    from . import pathfinder_server
     
     print "Running tests"
     logging.getLogger().setLevel(logging.DEBUG)
 
+    server = None
+    url = TEST_PATHFINDER_URL_ROOT
+    if not live:
+        server = pathfinder_server.PathfinderServer(key="ADMINSECRET").start()
+        url = server.url + "/cats/1248cat"
+
     print "Create a catalogue on Pathfinder"
-    p = Catalogue(TEST_PATHFINDER_URL_ROOT, "ADMINSECRET")
+    p = Catalogue(url, "ADMINSECRET")
     h1 = hypercat.Hypercat("Dummy test catalogue")
     p.create(h1)
 
@@ -116,9 +215,54 @@ def unittest():
     print h2.asJSON()
     assert(h1.asJSON() == h2.asJSON())
 
+    print "Creating it again without deleting it first should conflict"
+    try:
+        p.create(h1, autoDeleteFirst=False)
+        assert False, "Expected 409 Conflict"
+    except urllib2.HTTPError, e:
+        assert e.code == 409, e.code
+
+    if server:
+        print "A POST which times out on a kept-alive connection is not sent again"
+        import socket
+        slow = transport.Transport(timeout=0.2)
+        slow.get(url, "ADMINSECRET").read()     # (Leaves a connection in the pool)
+        posts = server.requests["POST"]
+        server.latency = 0.5
+        try:
+            slow.request("POST", server.url + "/cats/slow", "ADMINSECRET", h1.asJSONstr())
+            assert False, "Expected a timeout"
+        except socket.timeout:
+            pass
+        server.latency = 0.0
+        assert server.requests["POST"] == posts + 1, server.requests
+        slow.close()
+
+    print "Delete it"
+    p.delete()
+
+    print "Publish a big catalogue as shards, each a separate catalogue"
+    big = hypercat.Hypercat("Big test catalogue")
+    for i in range(25):
+        big.addItem(hypercat.Resource("Resource "+str(i), "text/plain"), "http://example.com/"+str(i))
+    sharded = hypercat.shard(big, url + "shard", maxItems=10)
+    publisher = Publisher("ADMINSECRET")
+    results = publisher.publish(sharded, url)
+    assert [r for (u, r, e) in results] == [CREATED] * 4, results
+    assert [u for (u, r, e) in results][1:] == [url + "shardp0", url + "shardp1", url + "shardp2"]
+    assert len(hypercat.loads(Catalogue(url + "shardp2", "ADMINSECRET").get()).items) == 5
+    assert [r for (u, r, e) in publisher.publish(sharded, url)] == [UNCHANGED] * 4
+    for (u, r, e) in results:
+        Catalogue(u, "ADMINSECRET").delete()
+
+    if server:
+        TRANSPORT.close()   # (so the server's keep-alive threads finish)
+        server.stop()
+
     print "All tests passed"
     
 if __name__ == '__main__':
     # Unit tests
-    unittest()
+    import sys
+    unittest(live="live" in sys.argv[1:])
 
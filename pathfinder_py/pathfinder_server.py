@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+#
+# PATHFINDER_SERVER.PY
+# Copyright (c) 2014 1248 Ltd.
+#
+# A local, in-process stand-in for a Pathfinder HyperCat server, for offline testing and load testing
+# of the crawl (leaderboard.py) and publish (pathfinder_client.py) paths
+#
+##Permission is hereby granted, free of charge, to any person obtaining a copy
+##of this software and associated documentation files (the "Software"), to deal
+##in the Software without restriction, including without limitation the rights
+##to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+##copies of the Software, and to permit persons to whom the Software is
+##furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included in
+##all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+##IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+##AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+##LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+##OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+##THE SOFTWARE.
+##
+## Usage:
+##    s = PathfinderServer(key="ADMINSECRET", latency=0.01)
+##    s.start()
+##    rootUrl = s.addSyntheticTree(depth=2, fanout=3, meters=10)
+##    ... crawl rootUrl, or create/get/delete catalogues under s.url+"/cats/" ...
+##    s.stop()
+##
+## Or from the command line:
+##    python pathfinder_server.py [port]
+##
+## Mimics Pathfinder:
+##    POST /cats/<name>     creates a catalogue, replying "Created"
+##                          ("409 Conflict" if it already exists, or the name isn't [A-Za-z0-9])
+##    GET /cats/<name>      reads it back (with an ETag, honouring If-None-Match), or simple-searches it with ?rel=&val=&href=
+##    DELETE /cats/<name>   deletes it, replying with an empty body
+## If a key is set, requests must pass it as the Basic Auth username (as per the HyperCat spec)
+##
+## Also serves synthetic catalogue trees of any size (under /synth/), whose resources are SenML energy meters
+## answering OpenIoT time-series queries (?start=&end=&interval=1h&rollup=avg) with hourly samples
+
+import re
+import sys
+import json
+import time
+import base64
+import socket
+import urlparse
+import hashlib
+import threading
+import SocketServer
+import BaseHTTPServer
+try:
+    from ..hypercat_py import hypercat      # When used as part of the Tools package
+except (ValueError, ImportError):
+    from hypercat_py import hypercat        # When Tools itself is on the path
+
+VALID_NAME = re.compile("^[A-Za-z0-9]+$")
+
+# Relations which leaderboard.py looks for on energy meters
+SENML_TYPE = "application/senml+json"
+SENML_UNITS_RELATION = "urn:X-senml:u"
+SUPPORTS_QUERY_RELATION = "urn:X-tsbiot:rels:supports:query"
+OPENIOT_QUERY = "urn:X-tsbiot:query:openiot:v1"
+
+def meterEnergy(n, t):
+    """The (synthetic) Total-Energy-To-Date of meter <n> at time <t>, in Joules"""
+    return (1000 + (n % 97) * 10) * t
+
+def _searched(body, query):
+    """Simple search over a stored catalogue, held as a JSON string"""
+    q = urlparse.parse_qs(query)
+    (rel, val, href) = [ q.get(k, [None])[0] for k in [hypercat.REL, hypercat.VAL, hypercat.HREF] ]
+    cat = json.loads(body)
+    def matches(i):
+        if (href is not None) and (i[hypercat.HREF] != href):
+            return False
+        return any(((rel is None) or (r[hypercat.REL] == rel)) and ((val is None) or (r[hypercat.VAL] == val)) for r in i[hypercat.ITEM_METADATA])
+    cat[hypercat.ITEMS] = [ i for i in cat[hypercat.ITEMS] if matches(i) ]
+    return json.dumps(cat, sort_keys=True, separators=(',', ':'))
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # Keep-alive
+    wbufsize = -1                   # Send each response in one go (flushed after each request),
+    disable_nagle_algorithm = True  # not line by line, so keep-alive doesn't wait on delayed ACKs
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body="", headers={}):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for (k, v) in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _begin(self, method):
+        """Common handling for every request. Returns False if the request has been answered already"""
+        pf = self.server.pathfinder
+        pf._count(method)
+        if pf.latency:
+            time.sleep(pf.latency)
+        if pf.key is not None:
+            expected = "Basic %s" % base64.b64encode(pf.key + ":")
+            if self.headers.getheader("Authorization") != expected:
+                self._reply(401, "Unauthorized", {"WWW-Authenticate" : 'Basic realm="pathfinder"'})
+                return False
+        return True
+
+    def do_GET(self):
+        if not self._begin("GET"):
+            return
+        pf = self.server.pathfinder
+        (path, dummy, query) = self.path.partition("?")
+        if path.startswith("/home/"):
+            return self._series(path, query)
+        with pf.lock:
+            entry = pf.catalogues.get(path)
+        if entry is None:
+            return self._reply(404, "Not found")
+        if isinstance(entry, hypercat.Hypercat):    # Synthetic
+            if query:
+                return self._reply(200, entry.searchQuery(query).asJSONstr())
+            (body, etag) = (entry.asJSONstr(), entry.etag())
+        else:
+            if query:
+                return self._reply(200, _searched(entry, query))
+            (body, etag) = (entry, '"' + hashlib.sha1(entry).hexdigest() + '"')
+        if self.headers.getheader("If-None-Match") == etag:
+            return self._reply(304, "", {"ETag" : etag})
+        self._reply(200, body, {"ETag" : etag, "Content-Type" : hypercat.CATALOGUE_TYPE})
+
+    def _series(self, path, query):
+        """An OpenIoT time-series query on a synthetic meter /home/<n>/MeterReader: hourly samples in [start, end)"""
+        try:
+            n = int(path.split("/")[2])
+            q = urlparse.parse_qs(query)
+            (start, end) = (int(q["start"][0]), int(q["end"][0]))
+        except (ValueError, IndexError, KeyError):
+            return self._reply(400, "Bad query")
+        start = start - (start % 3600) + (3600 if start % 3600 else 0)   # First whole hour
+        senml = { "e" : [ { "t" : t, "v" : meterEnergy(n, t) } for t in xrange(start, end, 3600) ] }
+        self._reply(200, json.dumps(senml), {"Content-Type" : SENML_TYPE})
+
+    def do_POST(self):
+        if not self._begin("POST"):
+            return
+        pf = self.server.pathfinder
+        body = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        name = self.path.rpartition("/")[2]
+        if (not self.path.startswith("/cats/")) or (not VALID_NAME.match(name)):
+            return self._reply(409, "Conflict: bad catalogue name")
+        try:
+            hypercat.loads(body)    # Validate
+        except Exception:
+            return self._reply(400, "Bad catalogue")
+        with pf.lock:
+            if self.path in pf.catalogues:
+                return self._reply(409, "Conflict: catalogue already exists")
+            pf.catalogues[self.path] = body
+        self._reply(200, "Created")
+
+    def do_DELETE(self):
+        if not self._begin("DELETE"):
+            return
+        pf = self.server.pathfinder
+        with pf.lock:
+            if self.path not in pf.catalogues:
+                return self._reply(404, "Not found")
+            del pf.catalogues[self.path]
+        self._reply(200, "")
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], socket.error):     # (A client hanging up, e.g. abandoning a response, is no error of ours)
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class PathfinderServer:
+    """An in-process HTTP server which behaves like Pathfinder"""
+    def __init__(self, host="127.0.0.1", port=0, key=None, latency=0.0):
+        """<port> 0 picks a free port. <latency> (in seconds) is added to every request"""
+        self.key = key
+        self.latency = latency
+        self.catalogues = {}    # path -> JSON string (if POSTed) or Hypercat (if synthetic)
+        self.requests = {}      # method -> count
+        self.lock = threading.Lock()
+        self.httpd = _Server((host, port), _Handler)
+        self.httpd.pathfinder = self
+        self.url = "http://%s:%d" % self.httpd.server_address
+        self.thread = None
+
+    def _count(self, method):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def start(self):
+        """Starts serving, on a background thread"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def addSyntheticTree(self, depth=2, fanout=3, meters=10, search=False, name="synth"):
+        """Serves a tree of catalogues <depth> levels deep below a root, each with <fanout> child catalogues,
+        and each leaf catalogue holding <meters> energy meters. Returns the URL of the root.
+        If <search>, every catalogue declares (and supports) simple search, and declares the content types it contains."""
+        counter = [0]
+        def build(path, level):
+            h = hypercat.Hypercat("Synthetic catalogue " + path)
+            if search:
+                h.supportsSimpleSearch()
+                h.containsContentType(hypercat.CATALOGUE_TYPE if level < depth else SENML_TYPE)
+            if level < depth:
+                h.addItems([ (build(path + "/" + str(i), level+1), self.url + path + "/" + str(i)) for i in range(fanout) ])
+            else:
+                children = []
+                for i in range(meters):
+                    n = counter[0]
+                    counter[0] += 1
+                    r = hypercat.Resource("Meter " + str(n), SENML_TYPE)
+                    r.addRelation(SENML_UNITS_RELATION, "J")
+                    r.addRelation(SUPPORTS_QUERY_RELATION, OPENIOT_QUERY)
+                    children.append((r, self.url + "/home/" + str(n) + "/MeterReader"))
+                h.addItems(children)
+            with self.lock:
+                self.catalogues[path] = h
+            return h
+        build("/" + name, 0)
+        return self.url + "/" + name
+
+if __name__ == '__main__':
+    import sys
+    s = PathfinderServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8002)
+    print "Serving a synthetic catalogue at", s.addSyntheticTree()
+    print "and Pathfinder catalogues under", s.url + "/cats/"
+    s.httpd.serve_forever()
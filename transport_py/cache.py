@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+#
+# CACHE.PY
+# Copyright (c) 2014 1248 Ltd.
+#
+# A persistent on-disk cache of fetched documents (e.g. HyperCat catalogues), so that re-crawls
+# cost only conditional GETs (mostly "304 Not Modified"), or in "trust" mode no requests at all
+#
+##Permission is hereby granted, free of charge, to any person obtaining a copy
+##of this software and associated documentation files (the "Software"), to deal
+##in the Software without restriction, including without limitation the rights
+##to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+##copies of the Software, and to permit persons to whom the Software is
+##furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included in
+##all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+##IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+##AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+##LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+##OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+##THE SOFTWARE.
+##
+## Usage:
+##    c = DiskCache("/var/cache/hypercat", maxBytes=100*1024*1024, ttl=3600)
+##    f = c.get(transport, "https://fred.com/cat", key="SECRETKEY")
+##    print f.read()
+##
+## Entries are keyed on (url, key), and stored as two files: <hash>.body, and <hash>.meta holding
+## the url, ETag, Last-Modified and time of last validation.
+## A fresh download is written to disk as the caller reads it, so callers can still stream.
+## When the cache grows beyond maxBytes, least-recently-used entries are evicted.
+
+import os
+import json
+import time
+import urllib2
+import hashlib
+import tempfile
+import threading
+
+class _Tee:
+    """Reads from a response, copying everything to a temporary file, and calls <onComplete> once it has all been read"""
+    def __init__(self, resp, tmp, onComplete, onAbandon):
+        self.resp = resp
+        self.tmp = tmp
+        self.onComplete = onComplete
+        self.onAbandon = onAbandon
+        self.done = False
+
+    def read(self, amt=None):
+        data = self.resp.read(amt) if amt else self.resp.read()
+        if not self.done:
+            self.tmp.write(data)
+            if (not data) or (not amt):
+                self.done = True
+                self.tmp.close()
+                self.onComplete()
+        return data
+
+    def close(self):
+        if not self.done:   # Only partly read, so not worth keeping
+            self.done = True
+            self.tmp.close()
+            self.onAbandon()
+        self.resp.close()
+
+class DiskCache:
+    """A bounded, persistent cache of HTTP GETs, validated with If-None-Match/If-Modified-Since"""
+    def __init__(self, directory, maxBytes=100*1024*1024, ttl=None):
+        """Entries younger than <ttl> seconds are trusted without asking the server (None means always ask)"""
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.size = sum([os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory) if f.endswith(".body")])
+        with self.lock:
+            self._evict()   # (maxBytes may have been reduced since last time)
+
+    def _paths(self, url, key):
+        h = hashlib.sha1(url.encode("utf-8") + "\0" + (key or "").encode("utf-8")).hexdigest()
+        base = os.path.join(self.directory, h)
+        return (base + ".body", base + ".meta")
+
+    def _readMeta(self, metaPath):
+        try:
+            with open(metaPath) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _writeMeta(self, metaPath, meta):
+        (fd, tmpPath) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(meta, f)
+        os.rename(tmpPath, metaPath)
+
+    def get(self, transport, url, key=None):
+        """Returns a file-like object holding the document at <url>, from the cache if it's still valid"""
+        (bodyPath, metaPath) = self._paths(url, key)
+        meta = self._readMeta(metaPath)
+        if meta and (self.ttl is not None) and (time.time() - meta["validated"] < self.ttl):
+            f = self._hit(bodyPath)
+            if f:
+                return f
+            meta = None     # Its body has gone (e.g. evicted by another thread)
+        headers = {}
+        if meta and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta and meta.get("lastModified"):
+            headers["If-Modified-Since"] = meta["lastModified"]
+        try:
+            resp = transport.get(url, key, headers)
+        except urllib2.HTTPError, e:
+            if (e.code != 304) or (meta is None):
+                raise
+            f = self._hit(bodyPath)
+            if not f:   # Its body has gone since we asked, so we have to fetch it after all
+                return self._fill(transport.get(url, key), url, bodyPath, metaPath)
+            meta["validated"] = time.time()
+            self._writeMeta(metaPath, meta)
+            return f
+        return self._fill(resp, url, bodyPath, metaPath)
+
+    def _hit(self, bodyPath):
+        """Opens a cached body, or returns None if it isn't there. (Once open, it can be read even if it's then evicted)"""
+        try:
+            f = open(bodyPath, "rb")
+        except IOError:
+            return None
+        try:
+            os.utime(bodyPath, None)    # Recently used, so evict it last
+        except OSError:
+            pass
+        return f
+
+    def _fill(self, resp, url, bodyPath, metaPath):
+        meta = {
+            "url" : url,
+            "etag" : resp.info().getheader("ETag"),
+            "lastModified" : resp.info().getheader("Last-Modified"),
+            "validated" : time.time() }
+        if not (meta["etag"] or meta["lastModified"] or (self.ttl is not None)):
+            return resp     # We'd never be able to use it
+        (fd, tmpPath) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+        def onComplete():
+            with self.lock:
+                if os.path.exists(bodyPath):
+                    self.size -= os.path.getsize(bodyPath)
+                os.rename(tmpPath, bodyPath)
+                self.size += os.path.getsize(bodyPath)
+                self._writeMeta(metaPath, meta)
+                self._evict()
+
+        def onAbandon():
+            os.remove(tmpPath)
+
+        return _Tee(resp, os.fdopen(fd, "wb"), onComplete, onAbandon)
+
+    def _evict(self):
+        """Removes least-recently-used entries until we're within maxBytes (call with lock held)"""
+        if self.size <= self.maxBytes:
+            return
+        bodies = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith(".body")]
+        bodies.sort(key=os.path.getmtime)
+        for bodyPath in bodies:
+            if self.size <= self.maxBytes:
+                break
+            self.size -= os.path.getsize(bodyPath)
+            os.remove(bodyPath)
+            metaPath = bodyPath[:-len(".body")] + ".meta"
+            if os.path.exists(metaPath):
+                os.remove(metaPath)
+
+    def clear(self):
+        with self.lock:
+            for f in os.listdir(self.directory):
+                if f.endswith(".body") or f.endswith(".meta"):
+                    os.remove(os.path.join(self.directory, f))
+            self.size = 0
+
+
+### Unit tests ###
+
+def unittest():
+    """Runs against a local stand-in Pathfinder server, which sends ETags and honours If-None-Match"""
+    import shutil
+    from . import transport
+    from ..pathfinder_py import pathfinder_server
+
+    print "Running tests"
+    server = pathfinder_server.PathfinderServer(key="SECRET").start()
+    t = transport.Transport()
+    directory = tempfile.mkdtemp()
+    def publish(name, description):
+        if ("/cats/" + name) in server.catalogues:
+            t.request("DELETE", server.url + "/cats/" + name, "SECRET").read()
+        body = '{"item-metadata":[{"rel":"urn:X-tsbiot:rels:isContentType","val":"application/vnd.tsbiot.catalogue+json"},' \
+               '{"rel":"urn:X-tsbiot:rels:hasDescription:en","val":"' + description + '"}],"items":[]}'
+        t.request("POST", server.url + "/cats/" + name, "SECRET", body).read()
+        return body
+    def gets():
+        return server.requests.get("GET", 0)
+    try:
+        url = server.url + "/cats/one"
+        one = publish("one", "first version")
+        c = DiskCache(directory)
+
+        print "A first get downloads it, storing it as it's read"
+        f = c.get(t, url, "SECRET")
+        assert isinstance(f, _Tee) and f.read() == one
+        assert sorted([n[-5:] for n in os.listdir(directory)]) == [".body", ".meta"]
+
+        print "Getting it again revalidates it, and the server's 304 means it comes from disk"
+        before = gets()
+        f = c.get(t, url, "SECRET")
+        assert isinstance(f, file) and f.read() == one and gets() == before + 1
+        f.close()
+
+        print "A changed document is downloaded again"
+        one = publish("one", "second version")
+        f = c.get(t, url, "SECRET")
+        assert isinstance(f, _Tee) and f.read() == one
+        assert c.get(t, url, "SECRET").read() == one
+
+        print "In trust mode, a recently validated document costs no request at all"
+        before = gets()
+        trusting = DiskCache(directory, ttl=3600)
+        assert trusting.get(t, url, "SECRET").read() == one and gets() == before
+
+        print "A body which has gone (e.g. evicted by another thread) is a miss, not an error"
+        os.remove(c._paths(url, "SECRET")[0])
+        assert trusting.get(t, url, "SECRET").read() == one
+        class Evicting:     # Evicts the body while the server is being asked if it's still valid
+            def get(self, url, key=None, headers={}):
+                if headers and os.path.exists(c._paths(url, key)[0]):
+                    os.remove(c._paths(url, key)[0])
+                return t.get(url, key, headers)
+        assert c.get(Evicting(), url, "SECRET").read() == one     # (So the server's 304 comes too late to help)
+
+        print "A partly-read download is abandoned, and not kept"
+        two = publish("two", "another catalogue")
+        f = c.get(t, server.url + "/cats/two", "SECRET")
+        assert f.read(10) == two[:10]
+        f.close()
+        assert not os.path.exists(c._paths(server.url + "/cats/two", "SECRET")[0])
+        assert not [n for n in os.listdir(directory) if n.endswith(".tmp")]
+        f = c.get(t, server.url + "/cats/two", "SECRET")
+        assert isinstance(f, _Tee) and f.read() == two
+
+        print "Least recently used entries are evicted to stay within maxBytes"
+        small = DiskCache(tempfile.mkdtemp(), maxBytes=len(one) + len(two) - 1)
+        try:
+            small.get(t, url, "SECRET").read()
+            small.get(t, server.url + "/cats/two", "SECRET").read()
+            assert not os.path.exists(small._paths(url, "SECRET")[0])
+            assert os.path.exists(small._paths(server.url + "/cats/two", "SECRET")[0]) and small.size == len(two)
+        finally:
+            shutil.rmtree(small.directory)
+    finally:
+        shutil.rmtree(directory)
+        t.close()   # (so the server's keep-alive threads finish)
+        server.stop()
+
+    print "All tests passed"
+
+if __name__ == '__main__':
+    # Unit tests (run as python -m Tools.transport_py.cache)
+    unittest()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+#
+# METRICS.PY
+# Copyright (c) 2014 1248 Ltd.
+#
+# Optional instrumentation of the network and parsing hot paths: each operation (an HTTP request, parsing a
+# document, loading a catalogue, scoring a resource) is reported as a span to any registered hooks.
+# With no hooks registered, instrumentation costs one function call per operation.
+#
+##Permission is hereby granted, free of charge, to any person obtaining a copy
+##of this software and associated documentation files (the "Software"), to deal
+##in the Software without restriction, including without limitation the rights
+##to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+##copies of the Software, and to permit persons to whom the Software is
+##furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included in
+##all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+##IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+##AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+##LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+##OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+##THE SOFTWARE.
+##
+## Usage:
+##    a = metrics.Aggregator()
+##    metrics.addHook(a)          # Any callable taking a Span will do, e.g. to forward spans to a tracing system
+##    ... run a crawl ...
+##    metrics.removeHook(a)
+##    print a.report()            # Count, total, and 50th/90th/99th percentiles of each span's duration and numeric attributes
+##
+## Instrumenting code:
+##    s = metrics.start("http", url=url)
+##    ...
+##    s.finish(status=200, bytes=1234)
+##
+## Spans reported by these tools:
+##    http              one HTTP request (transport.py): method, url, status, bytes, headerSeconds (time to response headers)
+##    parse             parsing a JSON document (leaderboard.py): url
+##    catalogue         fetching and parsing one catalogue, streamed (leaderboard.py): url, items
+##    crawl.catalogue   a catalogue found by a crawl, with no duration (leaderboard.py): url, depth
+##    score             calling the crawl's function on one resource (leaderboard.py): url
+
+import math
+import time
+import threading
+
+_hooks = []     # Called with each finished Span
+
+def addHook(fn):
+    global _hooks
+    _hooks = _hooks + [fn]  # Replaced rather than changed, so it's safe to iterate without a lock
+
+def removeHook(fn):
+    global _hooks
+    _hooks = [h for h in _hooks if h is not fn]
+
+def enabled():
+    return bool(_hooks)
+
+class Span:
+    """A timed operation, with attributes (such as url, status, bytes)"""
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.seconds = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def mark(self, attr):
+        """Sets attribute <attr> to the time taken so far"""
+        self.attrs[attr] = time.time() - self.start
+
+    def finish(self, **attrs):
+        if self.seconds is not None:    # Finished already
+            return
+        self.seconds = time.time() - self.start
+        self.attrs.update(attrs)
+        for hook in _hooks:
+            hook(self)
+
+class _NullSpan:
+    """What start() returns when nothing is listening"""
+    def set(self, **attrs):
+        pass
+
+    def mark(self, attr):
+        pass
+
+    def finish(self, **attrs):
+        pass
+
+NULL_SPAN = _NullSpan()
+
+def start(name, **attrs):
+    """Starts a span, which is reported to the hooks when finished"""
+    if not _hooks:
+        return NULL_SPAN
+    return Span(name, attrs)
+
+def record(name, **attrs):
+    """Reports an event with no duration"""
+    if _hooks:
+        span = Span(name, attrs)    # (Its seconds stay None: it has no duration, as opposed to a very short one)
+        for hook in _hooks:
+            hook(span)
+
+class Histogram:
+    """Counts of values in logarithmic buckets (each 2**(1/8), i.e. about 9%, wider than the last), so percentiles
+    are approximate but memory stays small however many values are added"""
+    STEPS_PER_DOUBLING = 8
+
+    def __init__(self):
+        self.buckets = {}   # bucket number -> count (values <= 0 go in bucket None)
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def add(self, v):
+        b = int(math.floor(math.log(v, 2) * self.STEPS_PER_DOUBLING)) if v > 0 else None
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+        self.count += 1
+        self.total += v
+        self.max = v if self.max is None else max(self.max, v)
+
+    def percentile(self, p):
+        """The (upper bound of the bucket holding the) <p>th percentile, or None if empty"""
+        if not self.count:
+            return None
+        target = self.count * p / 100.0
+        seen = 0
+        for b in sorted(self.buckets):  # (None sorts first)
+            seen += self.buckets[b]
+            if seen >= target:
+                if b is None:
+                    return 0.0
+                return min(2 ** (float(b+1) / self.STEPS_PER_DOUBLING), self.max)
+        return self.max
+
+class Aggregator:
+    """A hook which keeps histograms of the duration and each numeric attribute of every kind of span"""
+    PERCENTILES = [50, 90, 99]
+    COUNTED = ["status"]    # Attributes whose values are counted (as "status=200" etc.) rather than measured
+
+    def __init__(self):
+        self.histograms = {}    # (span name, "seconds" or attribute name) -> Histogram
+        self.lock = threading.Lock()
+
+    def __call__(self, span):
+        with self.lock:
+            if span.seconds is not None:
+                self._add(span.name, "seconds", span.seconds)
+            for (k, v) in span.attrs.items():
+                if k in self.COUNTED:
+                    self._add(span.name, "%s=%s" % (k, v), 1)
+                elif isinstance(v, (int, long, float)) and not isinstance(v, bool):
+                    self._add(span.name, k, v)
+
+    def _add(self, name, measure, v):
+        h = self.histograms.get((name, measure))
+        if h is None:
+            h = self.histograms[(name, measure)] = Histogram()
+        h.add(v)
+
+    def summary(self):
+        """Returns { span name : { measure : { "count", "total", "max", "p50", "p90", "p99" } } }"""
+        result = {}
+        with self.lock:
+            for ((name, measure), h) in self.histograms.items():
+                s = { "count" : h.count, "total" : h.total, "max" : h.max }
+                for p in self.PERCENTILES:
+                    s["p%d" % p] = h.percentile(p)
+                result.setdefault(name, {})[measure] = s
+        return result
+
+    def report(self):
+        """The summary as a table"""
+        lines = ["%-16s %-14s %8s %12s %12s %12s %12s %12s" % ("span", "measure", "count", "total", "p50", "p90", "p99", "max")]
+        summary = self.summary()
+        for name in sorted(summary):
+            for measure in sorted(summary[name]):
+                s = summary[name][measure]
+                lines.append("%-16s %-14s %8d %12.4g %12.4g %12.4g %12.4g %12.4g" % (name, measure, s["count"], s["total"], s["p50"], s["p90"], s["p99"], s["max"]))
+        return "\n".join(lines)
+
+
+### Unit tests ###
+
+def unittest():
+    """Checks the histograms on known data, and the http spans of requests to a local stand-in Pathfinder server"""
+    from . import transport, metrics    # (Not this module, if it's running as __main__: the one transport reports to)
+    from ..pathfinder_py import pathfinder_server
+
+    print "Running tests"
+    print "Each value falls in a bucket whose upper bound is at most 2**(1/8) above it"
+    for v in [0.001, 0.3, 1, 1.5, 2, 8, 100, 12345.678]:
+        h = metrics.Histogram()
+        h.add(v)
+        h.add(1e9)
+        bound = h.percentile(50)
+        assert v <= bound * (1 + 1e-12) and bound <= v * 2 ** (1.0 / metrics.Histogram.STEPS_PER_DOUBLING) * (1 + 1e-12), (v, bound)
+    h = metrics.Histogram()
+    assert h.percentile(50) is None
+    h.add(0)
+    h.add(-1)
+    assert h.percentile(99) == 0.0
+
+    print "Percentiles of known data are within a bucket of the true value"
+    h = metrics.Histogram()
+    for v in range(1, 1001):
+        h.add(v)
+    for (p, expected) in [(50, 500), (90, 900), (99, 990)]:
+        assert expected <= h.percentile(p) < expected * 1.1, (p, h.percentile(p))
+    assert h.percentile(100) == h.max == 1000 and h.count == 1000 and h.total == 500500
+
+    print "With no hooks registered, spans cost nothing and go nowhere"
+    assert (not metrics.enabled()) and metrics.start("http", url="x") is metrics.NULL_SPAN
+    metrics.record("crawl.catalogue", url="x", depth=1)
+    server = pathfinder_server.PathfinderServer().start()
+    t = transport.Transport()
+    try:
+        url = server.addSyntheticTree(depth=1, fanout=2, meters=1)
+        f = t.get(url)
+        assert f.span is metrics.NULL_SPAN
+        body = f.read()
+
+        print "An Aggregator summarises each kind of span, counting statuses and measuring everything else"
+        a = metrics.Aggregator()
+        metrics.addHook(a)
+        try:
+            assert metrics.enabled() and isinstance(metrics.start("http"), metrics.Span)
+            for i in range(3):
+                t.get(url).read()
+            metrics.record("crawl.catalogue", url=url, depth=2)
+            instant = metrics.Span("instant", {})
+            instant.seconds = 0.0   # (As a span finishing within the clock's resolution does)
+            a(instant)
+        finally:
+            metrics.removeHook(a)
+        assert not metrics.enabled()
+        s = a.summary()
+        assert s["http"]["seconds"]["count"] == 3 and s["http"]["status=200"]["count"] == 3, s["http"]
+        assert s["http"]["bytes"]["total"] == 3 * len(body) and s["http"]["headerSeconds"]["count"] == 3
+        assert s["crawl.catalogue"].keys() == ["depth"]     # (No duration)
+        assert s["instant"]["seconds"]["count"] == 1 and s["instant"]["seconds"]["total"] == 0.0, s["instant"]    # (But no time at all is still timed)
+        assert len(a.report().split("\n")) == 1 + len(s["http"]) + len(s["crawl.catalogue"]) + len(s["instant"])
+    finally:
+        t.close()   # (so the server's keep-alive threads finish)
+        server.stop()
+
+    print "All tests passed"
+
+if __name__ == '__main__':
+    # Unit tests (run as python -m Tools.transport_py.metrics)
+    unittest()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+# TRANSPORT.PY
+# Copyright (c) 2014 1248 Ltd.
+#
+# Shared HTTP transport for HyperCat clients: keeps connections alive and pooled per host,
+# so that crawling or publishing thousands of hrefs on one host doesn't pay a TCP/TLS handshake for each
+#
+##Permission is hereby granted, free of charge, to any person obtaining a copy
+##of this software and associated documentation files (the "Software"), to deal
+##in the Software without restriction, including without limitation the rights
+##to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+##copies of the Software, and to permit persons to whom the Software is
+##furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included in
+##all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+##IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+##AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+##LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+##OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+##THE SOFTWARE.
+##
+## Usage:
+##    t = Transport(poolSize=4, timeout=60)
+##    f = t.request("GET", "https://fred.com/cat", key="SECRETKEY")
+##    print f.read()      # Once the body has been read (or f closed), the connection goes back to the pool
+##
+## As per the HyperCat spec, the access <key>, if any, is passed as the Basic Auth username.
+## Errors are raised as urllib2.HTTPError, so existing callers' error handling still works.
+
+import time
+import errno
+import socket
+import base64
+import httplib
+import urllib2
+import urlparse
+import threading
+import StringIO
+import metrics
+
+IDEMPOTENT_METHODS = ["GET", "HEAD", "DELETE", "PUT"]
+RETRY_STATUSES = [502, 503, 504]    # Worth trying again (idempotent methods only)
+REDIRECT_STATUSES = [301, 302, 303, 307]
+MAX_REDIRECTS = 5
+
+def _closedBeforeResponding(e):
+    """Does error <e> mean the server closed a kept-alive connection without responding (so the request can safely be sent again)?
+    A timeout doesn't: the server may still be working on it."""
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    return isinstance(e, socket.error) and (not isinstance(e, socket.timeout)) and (e.errno in [errno.ECONNRESET, errno.EPIPE])
+
+class Response:
+    """A file-like HTTP response, which returns its connection to the pool once it has been completely read"""
+    def __init__(self, transport, url, poolKey, conn, resp, span=metrics.NULL_SPAN):
+        self.transport = transport
+        self.url = url
+        self.poolKey = poolKey
+        self.conn = conn
+        self.resp = resp
+        self.status = resp.status
+        self.reason = resp.reason
+        self.span = span
+        self.bytes = 0
+        self._released = False
+        self._finished()    # (e.g. empty bodies are finished already)
+
+    def _finished(self):
+        if (not self._released) and self.resp.isclosed():
+            self._released = True
+            self.span.finish(status=self.status, bytes=self.bytes)
+            if self.resp.will_close:
+                self.conn.close()
+            else:
+                self.transport._release(self.poolKey, self.conn)
+
+    def read(self, amt=None):
+        data = self.resp.read(amt) if amt else self.resp.read()
+        self.bytes += len(data)
+        self._finished()
+        return data
+
+    def getheader(self, name, default=None):
+        return self.resp.getheader(name, default)
+
+    def info(self):
+        return self.resp.msg
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        """Closes the response. If it hasn't been completely read, its connection can't be reused."""
+        if not self._released:
+            self._released = True
+            self.span.finish(status=self.status, bytes=self.bytes)
+            self.conn.close()
+
+class Transport:
+    """Makes HTTP(S) requests over keep-alive connections, pooled per host, retrying failures with exponential backoff"""
+    def __init__(self, poolSize=4, timeout=60, retries=3, backoff=0.5):
+        """<poolSize> is the number of idle connections kept open to each host (any number may be in use at once)
+        <timeout> is in seconds. Failed requests are retried up to <retries> times, after <backoff>, 2*<backoff>, 4*<backoff>... seconds"""
+        self.poolSize = poolSize
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pools = {}     # (scheme, host:port) -> list of idle connections
+        self.authHeaders = {}   # key -> Authorization header
+        self.lock = threading.Lock()
+
+    def _authHeader(self, key):
+        if key not in self.authHeaders:
+            self.authHeaders[key] = "Basic %s" % base64.encodestring(key+":")[:-1]  # key is passed as username in "username:password". Remove trailing \n
+        return self.authHeaders[key]
+
+    def _acquire(self, poolKey):
+        """Returns (connection, reused)"""
+        with self.lock:
+            idle = self.pools.get(poolKey)
+            if idle:
+                return (idle.pop(), True)
+        (scheme, netloc) = poolKey
+        if scheme == "https":
+            return (httplib.HTTPSConnection(netloc, timeout=self.timeout), False)
+        return (httplib.HTTPConnection(netloc, timeout=self.timeout), False)
+
+    def _release(self, poolKey, conn):
+        with self.lock:
+            idle = self.pools.setdefault(poolKey, [])
+            if len(idle) < self.poolSize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _send(self, method, url, body, headers):
+        """Makes one request, on a pooled connection if there is one (retrying at once if the server turns out to have closed it)"""
+        (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+        poolKey = (scheme, netloc)
+        target = urlparse.urlunsplit(("", "", path or "/", query, ""))
+        while True:
+            (conn, reused) = self._acquire(poolKey)
+            span = metrics.start("http", method=method, url=url)
+            try:
+                conn.request(method, target, body, headers)
+                resp = conn.getresponse()
+                span.mark("headerSeconds")
+                return Response(self, url, poolKey, conn, resp, span)
+            except (socket.error, httplib.HTTPException), e:
+                span.finish(error=repr(e))
+                conn.close()
+                if not (reused and _closedBeforeResponding(e)):    # A stale keep-alive connection is no reason to give up
+                    raise
+
+    def request(self, method, url, key=None, body=None, headers={}):
+        """Makes an HTTP request, returning a file-like Response. Raises urllib2.HTTPError if the status isn't 2xx"""
+        if urlparse.urlsplit(url).scheme not in ["http", "https"]:  # e.g. file://
+            return urllib2.urlopen(url, body, self.timeout)
+        headers = dict(headers)
+        if key != None:
+            # Sent up-front, so this works even if the site doesn't send back a 401 in response to a non-auth request
+            headers["Authorization"] = self._authHeader(key)
+        for redirect in range(MAX_REDIRECTS+1):
+            resp = self._retrying(method, url, body, headers)
+            if (resp.status in REDIRECT_STATUSES) and (method in ["GET", "HEAD"]) and resp.getheader("Location"):
+                resp.read()
+                url = urlparse.urljoin(url, resp.getheader("Location"))
+                continue
+            break
+        if resp.status >= 300:
+            raise urllib2.HTTPError(url, resp.status, resp.reason, resp.info(), StringIO.StringIO(resp.read()))
+        return resp
+
+    def _retrying(self, method, url, body, headers):
+        attempt = 0
+        while True:
+            try:
+                resp = self._send(method, url, body, headers)
+                if (resp.status not in RETRY_STATUSES) or (method not in IDEMPOTENT_METHODS) or (attempt >= self.retries):
+                    return resp
+                resp.read()
+            except (socket.error, httplib.HTTPException), e:
+                if (method not in IDEMPOTENT_METHODS) or (attempt >= self.retries) or isinstance(e, socket.timeout):    # (Waiting again would take as long again)
+                    raise
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    def get(self, url, key=None, headers={}):
+        return self.request("GET", url, key, headers=headers)
+
+    def close(self):
+        """Closes all idle connections"""
+        with self.lock:
+            for idle in self.pools.values():
+                for conn in idle:
+                    conn.close()
+            self.pools = {}